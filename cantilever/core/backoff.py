@@ -0,0 +1,86 @@
+import random
+import time
+
+# What to do when the observer cannot keep up:
+#
+#  * raise: raise ``Backpressure`` (or ``queue.Full``)
+#  * block: wait up to ``block_timeout`` for some room, then drop
+#  * drop: drop the newest events
+#  * overwrite: overwrite the oldest events
+#  * sample: keep events with a probability that goes down as the buffer fills up
+#
+BACKPRESSURE_POLICIES = ("raise", "block", "drop", "overwrite", "sample")
+
+
+class AdaptiveWait:
+    """Wait strategy used when there is nothing to do
+
+    The first ``spin`` idle rounds return immediately (lowest latency),
+    the next ``yields`` rounds give up the CPU/GIL with ``time.sleep(0)``,
+    after that every round blocks for up to ``timeout`` seconds,
+    usually on a doorbell rung by the other side.
+
+    .. code-block:: python
+
+       # Previous behaviour, burns a full core
+       busy = AdaptiveWait(spin=float("inf"))
+
+       # Never spin, always block
+       blocking = AdaptiveWait(spin=0, yields=0)
+
+    """
+
+    def __init__(self, spin=64, yields=64, timeout=0.05):
+        self.spin = spin
+        self.yields = yields
+        self.timeout = timeout
+        self.rounds = 0
+
+    def reset(self):
+        """Work was found, next idle round starts spinning again"""
+        self.rounds = 0
+
+    def idle(self, block=time.sleep):
+        """Nothing to do, wait according to the current phase.
+
+        ``block(timeout)`` is called in the blocking phase; if it returns a truthy value
+        work was found while blocking and the strategy is reset
+        """
+        self.rounds += 1
+
+        if self.rounds <= self.spin:
+            return
+
+        if self.rounds <= self.spin + self.yields:
+            time.sleep(0)
+            return
+
+        if block(self.timeout):
+            self.reset()
+
+    def until(self, predicate, block=time.sleep):
+        """Wait until ``predicate()`` is true"""
+        self.reset()
+
+        while not predicate():
+            self.idle(block)
+
+
+def keep_sample(depth, size, threshold=0.5):
+    """Sampling under pressure, everything is kept until the buffer is ``threshold`` full
+    then the probability of keeping an event goes down linearly to 0 when full
+    """
+    start = size * threshold
+
+    if depth <= start:
+        return True
+
+    return random.random() * (size - start) > depth - start
+
+
+def check_policy(policy):
+    if policy not in BACKPRESSURE_POLICIES:
+        raise ValueError(
+            f"Unknown backpressure policy {policy}, expected {BACKPRESSURE_POLICIES}"
+        )
+    return policy
@@ -4,7 +4,7 @@ from math import log10, sqrt
 from typing import Callable, Dict, List
 
 from .report import print_table
-from .statstream import StatStream
+from .statstream import StatStream, pack_tree, unpack_tree
 
 
 def chrono(func: Callable):
@@ -87,9 +87,39 @@ class ChronoContext:
 
 
 class MultiStageChrono:
-    def __init__(self, skip_obs=10, sync=None, disabled=False, name=None):
+    """Time the stages of a program, one :class:`StatStream` per stage
+
+    Parameters
+    ----------
+    shared: bool
+        Store the timings in shared memory so child processes can update them,
+        see :class:`StatStream`
+
+    sketch: bool
+        Estimate the p50, p95 and p99 of each stage, they are added to the reports
+
+    make_stream:
+        ``make_stream(drop_first_obs=skip_obs)`` makes the stream of a stage,
+        for example ``partial(WindowStatStream, 100)`` to report on the last 100 observations;
+        ``shared`` and ``sketch`` are ignored when it is set
+
+    """
+
+    def __init__(
+        self,
+        skip_obs=10,
+        sync=None,
+        disabled=False,
+        name=None,
+        shared=False,
+        sketch=False,
+        make_stream=None,
+    ):
         self.chronos = {}
         self.skip_obs = skip_obs
+        self.shared = shared
+        self.sketch = sketch
+        self.make_stream = make_stream
         self.sync = sync
         self.name = name
         self.disabled = disabled
@@ -107,9 +137,13 @@ class MultiStageChrono:
         val = self.chronos.get(name)
 
         if val is None:
-            val = StatStream(self.skip_obs)
-            if skip_obs is not None:
-                val = StatStream(skip_obs)
+            if skip_obs is None:
+                skip_obs = self.skip_obs
+
+            if self.make_stream is not None:
+                val = self.make_stream(drop_first_obs=skip_obs)
+            else:
+                val = StatStream(skip_obs, shared=self.shared, sketch=self.sketch)
             self.chronos[name] = val
 
         # inherit sync from parent
@@ -118,12 +152,24 @@ class MultiStageChrono:
 
         return ChronoContext(name, val, parent=self, **kwargs)
 
+    def _percentile_columns(self):
+        # from the streams themselves, make_stream or a restore can add a sketch
+        columns = {}
+        for stream in self.chronos.values():
+            columns.update(dict.fromkeys(stream.percentiles()))
+        return list(columns)
+
     def make_table(self, common: List = None, transform=None):
         common = common or []
         table = []
 
+        # the stages without sketch leave the percentile columns empty
+        width = 5 + len(self._percentile_columns())
+
         for i, (name, stream) in enumerate(self.chronos.items()):
-            table.append([name] + stream.to_array(transform) + common)
+            row = stream.to_array(transform)
+            row.extend(["NA"] * (width - len(row)))
+            table.append([name] + row + common)
 
         return table
 
@@ -152,6 +198,7 @@ class MultiStageChrono:
         common = list(map(lambda item: item[1], items))
 
         header = ["Stage", "Average", "Deviation", "Min", "Max", "count"]
+        header.extend(self._percentile_columns())
         header.extend(common_header)
 
         table = (
@@ -174,6 +221,19 @@ class MultiStageChrono:
 
         return items
 
+    def snapshot(self):
+        """Statistics of every stage as bytes, to be saved alongside a checkpoint"""
+        return pack_tree(
+            [(name, stream.snapshot()) for name, stream in self.chronos.items()]
+        )
+
+    def restore(self, data):
+        """Replace the statistics of the stages by the ones saved with :meth:`snapshot`,
+        warm-up included
+        """
+        for name, snapshot in unpack_tree(data):
+            self.chronos[name] = StatStream.from_snapshot(snapshot, shared=self.shared)
+
     def to_json(self, base=None, *args, **kwargs):
         if "indent" not in kwargs:
             kwargs["indent"] = "  "
@@ -222,7 +282,8 @@ def show_eta(i: int, n: int, timer: StatStream, end="\n"):
 
     total = ""
     if timer.avg != 0:
-        t = timer.avg * (timer.count + timer.drop_obs)
+        # every observation, count only covers the window of a windowed stream
+        t = timer.avg * timer.current_count
         div, fmt = get_div_fmt(t)
         total = f" | Total {t / div:6.2f} {fmt}"
 
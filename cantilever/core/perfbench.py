@@ -0,0 +1,391 @@
+"""Benchmark the perf counter backends
+
+Measures the cost of the instrumentation itself: push overhead and latency percentiles,
+producer slowdown compared to the same workload without pushing, sustained throughput,
+consumer lag and backpressure, for every combination of the swept parameters.
+
+.. code-block:: bash
+
+   python -m cantilever.core.perfbench --backend thread shm --rate 0 10000 \\
+        --producers 1 4 --output bench.json
+
+   # fails if the push overhead went up by more than 50%
+   python -m cantilever.core.perfbench --compare bench.json --tolerance 1.5
+
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+from .perfcounter import Observer, PerfCounter
+from .report import PrintTable
+
+COLUMNS = [
+    "Backend",
+    "Rate",
+    "Payload",
+    "Size",
+    "Producers",
+    "Push ns",
+    "p99 ns",
+    "Slowdown",
+    "Obj/s",
+    "Lag p99 ns",
+    "Dropped",
+]
+
+# fields compared by :func:`compare`, lower is better
+REGRESSION_FIELDS = ("push_mean_ns", "push_p99_ns")
+
+
+def percentiles(values, qs=(50, 99, 99.9)):
+    """Nearest rank percentiles, ``{p50: ..., p99: ..., p999: ...}``"""
+    values = sorted(values)
+    result = {}
+
+    for q in qs:
+        name = "p" + f"{q:g}".replace(".", "")
+        if not values:
+            result[name] = 0
+            continue
+
+        rank = min(int(len(values) * q / 100), len(values) - 1)
+        result[name] = values[rank]
+
+    return result
+
+
+class LagObserver(Observer):
+    """Measure the time between the push and the delivery, saved to ``path`` on exit"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lags = []
+
+    def __call__(self, obj):
+        self.lags.append(time.monotonic_ns() - obj["time"])
+
+    def on_batch(self, objects):
+        now = time.monotonic_ns()
+        self.lags.extend(now - obj["time"] for obj in objects)
+
+    def __exit__(self, *args):
+        lags = percentiles(self.lags)
+
+        with open(self.path, "w") as fp:
+            json.dump(dict(delivered=len(self.lags), lags=lags), fp)
+
+
+def _work(iterations):
+    # stand in for the instrumented code
+    acc = 0
+    for i in range(iterations):
+        acc += i * i
+    return acc
+
+
+def _pace(start, index, rate):
+    if not rate:
+        return
+
+    delay = start + index / rate - time.perf_counter()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def _produce(push, events, rate, payload, work, timings):
+    fields = {f"f{i}": i for i in range(payload)}
+    start = time.perf_counter()
+
+    for i in range(events):
+        _pace(start, i, rate)
+        _work(work)
+
+        s = time.perf_counter_ns()
+        if push is not None:
+            push(name="bench", time=time.monotonic_ns(), **fields)
+        timings.append(time.perf_counter_ns() - s)
+
+
+def _run_threads(push, events, rate, payload, work, producers):
+    timings = [[] for _ in range(producers)]
+    threads = [
+        threading.Thread(
+            target=_produce,
+            args=(push, events // producers, rate / producers, payload, work, t),
+        )
+        for t in timings
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return time.perf_counter() - start, [t for ts in timings for t in ts]
+
+
+async def _produce_async(push, events, rate, payload, work, timings):
+    fields = {f"f{i}": i for i in range(payload)}
+    start = time.perf_counter()
+
+    for i in range(events):
+        if rate:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif i % 64 == 0:
+            # let the observer task run
+            await asyncio.sleep(0)
+
+        _work(work)
+
+        s = time.perf_counter_ns()
+        push(name="bench", time=time.monotonic_ns(), **fields)
+        timings.append(time.perf_counter_ns() - s)
+
+
+def _run_async(counter, events, rate, payload, work, producers):
+    async def main():
+        timings = [[] for _ in range(producers)]
+
+        async with counter:
+            start = time.perf_counter()
+            await asyncio.gather(
+                *(
+                    _produce_async(
+                        counter.push_object,
+                        events // producers,
+                        rate / producers,
+                        payload,
+                        work,
+                        t,
+                    )
+                    for t in timings
+                )
+            )
+            elapsed = time.perf_counter() - start
+
+        return elapsed, [t for ts in timings for t in ts]
+
+    return asyncio.run(main())
+
+
+def run_case(
+    backend, rate=0, payload=1, size=20000, producers=1, events=2000, work=100
+):
+    """Run one benchmark case
+
+    Parameters
+    ----------
+    rate: float
+        Objects pushed per second by all the producers, ``0`` pushes as fast as possible
+
+    payload: int
+        Number of integer fields in each object, on top of ``name`` and ``time``
+
+    work: int
+        Iterations of busy work between two pushes
+
+    """
+    baseline, _ = _run_threads(None, events, rate, payload, work, producers)
+
+    fd, path = tempfile.mkstemp(prefix="perfbench_", suffix=".json")
+    os.close(fd)
+
+    try:
+        counter = PerfCounter(LagObserver, (path,), backend=backend, size=size)
+
+        start = time.perf_counter()
+        if backend == "async":
+            elapsed, timings = _run_async(
+                counter, events, rate, payload, work, producers
+            )
+        else:
+            with counter:
+                elapsed, timings = _run_threads(
+                    counter.push_object, events, rate, payload, work, producers
+                )
+        # includes the time needed to deliver everything
+        total = time.perf_counter() - start
+
+        with open(path) as fp:
+            observed = json.load(fp)
+    finally:
+        os.remove(path)
+
+    push = percentiles(timings)
+    counters = counter.counters()
+
+    return dict(
+        backend=backend,
+        rate=rate,
+        payload=payload,
+        size=size,
+        producers=producers,
+        events=len(timings),
+        push_mean_ns=sum(timings) / max(len(timings), 1),
+        push_p50_ns=push["p50"],
+        push_p99_ns=push["p99"],
+        push_p999_ns=push["p999"],
+        baseline_s=baseline,
+        elapsed_s=elapsed,
+        slowdown=(elapsed - baseline) / baseline,
+        delivered=observed["delivered"],
+        throughput=observed["delivered"] / total,
+        lag_p50_ns=observed["lags"]["p50"],
+        lag_p99_ns=observed["lags"]["p99"],
+        lag_p999_ns=observed["lags"]["p999"],
+        dropped=counters["dropped"],
+        overwritten=counters["overwritten"],
+        high_water=counters["high_water"],
+        consumer_cpu_s=counter.consumer_cpu_time,
+    )
+
+
+def sweep(
+    backends=("thread", "queue", "shm", "async"),
+    rates=(0,),
+    payloads=(1,),
+    sizes=(20000,),
+    producers=(1,),
+    events=2000,
+    work=100,
+):
+    """Run :func:`run_case` for every combination of the parameters"""
+    results = []
+
+    for backend, rate, payload, size, producer in itertools.product(
+        backends, rates, payloads, sizes, producers
+    ):
+        results.append(run_case(backend, rate, payload, size, producer, events, work))
+
+    return results
+
+
+def machine():
+    return dict(
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        platform=platform.platform(),
+        processor=platform.processor(),
+        cpu_count=os.cpu_count(),
+        time=time.time(),
+    )
+
+
+def save(results, path):
+    with open(path, "w") as fp:
+        json.dump(dict(machine=machine(), results=results), fp, indent=2)
+
+
+def load(path):
+    with open(path) as fp:
+        return json.load(fp)["results"]
+
+
+def _case(result):
+    return tuple(result[k] for k in ("backend", "rate", "payload", "size", "producers"))
+
+
+def compare(previous, results, tolerance=1.5):
+    """Cases for which a :data:`REGRESSION_FIELDS` got more than ``tolerance`` times worse
+
+    Returns a list of ``(case, field, previous value, new value)``
+    """
+    previous = {_case(r): r for r in previous}
+    regressions = []
+
+    for result in results:
+        before = previous.get(_case(result))
+        if before is None:
+            continue
+
+        for field in REGRESSION_FIELDS:
+            if result[field] > before[field] * tolerance:
+                regressions.append((_case(result), field, before[field], result[field]))
+
+    return regressions
+
+
+def make_table(results):
+    return [
+        [
+            r["backend"],
+            r["rate"],
+            r["payload"],
+            r["size"],
+            r["producers"],
+            r["push_mean_ns"],
+            r["push_p99_ns"],
+            r["slowdown"],
+            r["throughput"],
+            r["lag_p99_ns"],
+            r["dropped"],
+        ]
+        for r in results
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--backend", nargs="+", default=["thread", "queue", "shm", "async"]
+    )
+    parser.add_argument(
+        "--rate", nargs="+", type=float, default=[0], help="objects per second"
+    )
+    parser.add_argument(
+        "--payload", nargs="+", type=int, default=[1], help="fields per object"
+    )
+    parser.add_argument("--size", nargs="+", type=int, default=[20000])
+    parser.add_argument("--producers", nargs="+", type=int, default=[1])
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument(
+        "--work", type=int, default=100, help="busy loop iterations between pushes"
+    )
+    parser.add_argument("--output", default=None, help="save the results as json")
+    parser.add_argument(
+        "--compare", default=None, help="results of a previous run to compare to"
+    )
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    args = parser.parse_args(argv)
+
+    results = sweep(
+        args.backend,
+        args.rate,
+        args.payload,
+        args.size,
+        args.producers,
+        args.events,
+        args.work,
+    )
+
+    PrintTable(COLUMNS, make_table(results)).print(mode="md")
+
+    if args.output:
+        save(results, args.output)
+
+    if args.compare:
+        regressions = compare(load(args.compare), results, args.tolerance)
+
+        for case, field, before, after in regressions:
+            print(f"Regression {case} {field}: {before:.0f} -> {after:.0f}")
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,477 @@
+"""Single entry point for the perf counters
+
+All the backends deliver the pushed objects to the same observer protocol,
+an observer written once works with any of them.
+
+.. code-block:: python
+
+   class Printer(Observer):
+       def __call__(self, obj):
+           print(obj)
+
+   with PerfCounter(Printer, (), backend="auto", rate=1000) as counter:
+       counter.push_object(name="batch", time=time.time_ns(), batch_size=1024)
+
+"""
+
+import importlib
+import inspect
+import time
+import traceback
+import warnings
+from collections import deque
+
+# State shared by the queue, thread and async backends with their worker,
+# the shm ring has its own header, see ``perfcounter_shm.SHM_*``
+STATE_ON = -1
+STATE_CPU_TIME = -2
+STATE_DROPPED = -3
+STATE_OVERWRITTEN = -4
+STATE_HIGH_WATER = -5
+STATE_MAX = 5
+
+BACKENDS = ("thread", "queue", "shm", "async")
+
+# backends ``auto`` selects from, they accept any value.
+# shm only stores numbers, bools and short str/bytes, it has to be asked for explicitly
+AUTO_BACKENDS = ("thread", "queue")
+
+my_perf_counter = time.perf_counter_ns
+
+
+class Observer:
+    """Receive the objects pushed to a perf counter, in order
+
+    ``on_batch(objects)`` can be implemented to receive all the objects available at once.
+    """
+
+    def __init__(self) -> None:
+        pass
+
+    def __call__(self, obj):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def counters(self):
+        """Backpressure counters, replaced by a live view when running inside the worker"""
+        return dict(dropped=0, overwritten=0, high_water=0)
+
+
+def read_counters(state):
+    return dict(
+        dropped=int(state[STATE_DROPPED]),
+        overwritten=int(state[STATE_OVERWRITTEN]),
+        high_water=int(state[STATE_HIGH_WATER]),
+    )
+
+
+def _count(msg):
+    if isinstance(msg, list):
+        return len(msg)
+    return 1
+
+
+def _dispatch(observer, msg):
+    # batches pushed with push_many/commit are sent as a single list
+    if isinstance(msg, list):
+        for obj in msg:
+            _dispatch(observer, obj)
+        return
+
+    try:
+        observer(msg)
+    except Exception:
+        traceback.print_exc()
+
+
+def _dispatch_batch(observer, messages):
+    # flatten the batches pushed with push_many/commit
+    batch = []
+    for msg in messages:
+        if isinstance(msg, list):
+            batch.extend(msg)
+        else:
+            batch.append(msg)
+
+    try:
+        observer.on_batch(batch)
+    except Exception:
+        traceback.print_exc()
+
+
+class NotInitialized(Exception):
+    pass
+
+
+class Backpressure(Exception):
+    pass
+
+
+class WorkerStopped(Exception):
+    pass
+
+
+class Reservation:
+    """Objects buffered locally, they are sent to the worker in a single message once committed"""
+
+    def __init__(self, count):
+        self.count = count
+        self.objects = []
+
+    def push_object(self, **kwargs):
+        self.objects.append(kwargs)
+
+
+class MessageBatching:
+    """``push_many``, ``reserve`` and ``commit`` of the backends sending whole objects,
+    a batch of objects travels to the worker as a single message.
+    The backend provides ``_put(msg)`` and keeps the worker flag in ``state[STATE_ON]``
+    """
+
+    def _running(self):
+        return self.state[STATE_ON] != 0
+
+    def _put_many(self, objects):
+        self._put(objects)
+
+    def push_many(self, objects):
+        """Push a sequence of objects as a single message"""
+        if not self._running():
+            raise WorkerStopped()
+
+        self._put_many(list(objects))
+
+    def reserve(self, count):
+        """Buffer up to ``count`` objects locally, nothing is sent until :meth:`commit`"""
+        return Reservation(count)
+
+    def commit(self, reservation):
+        """Send the objects buffered in the reservation"""
+        if reservation.objects:
+            self.push_many(reservation.objects)
+
+
+class ObjectAssembler(Observer):
+    def __init__(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return
+
+    def push(self, object):
+        pass
+
+    def on_batch(self, objects):
+        push = self.push
+        for obj in objects:
+            push(obj)
+
+    def __call__(self, obj):
+        self.push(obj)
+
+
+class ReplayBuffer:
+    """Objects pushed before anything subscribed, they are replayed once on subscription.
+
+    At most ``size`` objects no older than ``age`` seconds are kept, the oldest are dropped first.
+    """
+
+    def __init__(self, size=1024, age=None):
+        self.objects = deque()
+        self.size = size
+        self.age = age
+        self.dropped = 0
+
+    def _expire(self, now):
+        objects = self.objects
+        while objects and now - objects[0][0] > self.age:
+            objects.popleft()
+            self.dropped += 1
+
+    def append(self, obj):
+        now = time.monotonic()
+        objects = self.objects
+
+        if self.age is not None:
+            self._expire(now)
+
+        if len(objects) >= self.size:
+            objects.popleft()
+            self.dropped += 1
+
+        objects.append((now, obj))
+
+    def extend(self, objs):
+        for obj in objs:
+            self.append(obj)
+
+    def flush(self):
+        """Returns the buffered objects in order and empties the buffer"""
+        if self.age is not None:
+            self._expire(time.monotonic())
+
+        objs = [obj for _, obj in self.objects]
+        self.objects.clear()
+
+        if self.dropped:
+            warnings.warn(
+                f"{self.dropped} objects were dropped before the first subscription"
+            )
+
+        return objs
+
+
+class Source(ObjectAssembler):
+    """Feed the objects to a :class:`~cantilever.core.stream.Stream`
+
+    ``handler(source, observer, scheduler)`` builds the pipeline when the worker starts,
+    see :mod:`cantilever.core.stream` for the operators, reactivex operators need :class:`RxSource`.
+    The batches delivered by the worker go through the pipeline as a whole.
+
+    Objects pushed before anything subscribed to the source are kept in a :class:`ReplayBuffer`
+    of ``replay_size`` objects no older than ``replay_age`` seconds.
+    """
+
+    def __init__(self, handler, replay_size=1024, replay_age=None) -> None:
+        super().__init__()
+        self.handler = handler
+        self.source = None
+        self.pending = ReplayBuffer(replay_size, replay_age)
+        self.dropped = 0
+
+    def __enter__(self):
+        from .stream import Stream
+
+        self.source = Stream()
+        self.handler(self.source, lambda: self.source, lambda: None)
+        return self
+
+    def __exit__(self, *args):
+        self.replay()
+        self.source.on_completed()
+
+    @property
+    def replay_dropped(self):
+        """Number of objects the replay buffer could not keep"""
+        if self.pending is None:
+            return self.dropped
+        return self.pending.dropped
+
+    def replay(self):
+        """Send the buffered objects once something subscribed, returns false until then"""
+        if self.pending is None:
+            return True
+
+        source = self.source
+        if not (source.children or source.subscribers):
+            return False
+
+        pending, self.pending = self.pending, None
+        objects = pending.flush()
+        self.dropped = pending.dropped
+
+        if objects:
+            source.on_batch(objects)
+        return True
+
+    def push(self, object):
+        if self.pending is None or self.replay():
+            self.source.on_next(object)
+        else:
+            self.pending.append(object)
+
+    def on_batch(self, objects):
+        if self.pending is None or self.replay():
+            self.source.on_batch(objects)
+        else:
+            self.pending.extend(objects)
+
+
+class RxSource(ObjectAssembler):
+    """Feed the objects to a reactivex observable, requires ``reactivex``
+
+    Objects pushed before the observable was subscribed to are replayed once on subscription,
+    see :class:`Source`.
+    """
+
+    def __init__(self, handler, replay_size=1024, replay_age=None) -> None:
+        super().__init__()
+        self.reactivex_observer = None
+        self.reactivex_scheduler = None
+        self.source = None
+        self.handler = handler
+        self.pending = ReplayBuffer(replay_size, replay_age)
+
+    def __enter__(self):
+        def make(observer, scheduler):
+            self.reactivex_observer = observer
+            self.reactivex_scheduler = scheduler
+
+            for obj in self.pending.flush():
+                observer.on_next(obj)
+
+        import reactivex as rx
+
+        self.source = rx.create(make)
+        self.handler(
+            self.source,
+            lambda: self.reactivex_observer,
+            lambda: self.reactivex_scheduler,
+        )
+        return self
+
+    def __exit__(self, *args):
+        if self.reactivex_observer:
+            self.reactivex_observer.on_completed()
+        else:
+            raise RuntimeError("reactivex_observer was never set")
+        return
+
+    @property
+    def replay_dropped(self):
+        """Number of objects the replay buffer could not keep"""
+        return self.pending.dropped
+
+    def push(self, object):
+        if self.reactivex_observer:
+            self.reactivex_observer.on_next(object)
+        else:
+            self.pending.append(object)
+
+
+def backend_class(backend):
+    """PerfCounter class of a backend, the modules are only imported when used"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected {BACKENDS} or auto")
+
+    module = importlib.import_module(f".perfcounter_{backend}", __package__)
+    return module.PerfCounter
+
+
+def _adapt(backend, observer_cls, observer_args):
+    # the shm ring carries key/value records, assemble them back into objects
+    if backend == "shm":
+        from .perfcounter_shm import Assembled
+
+        return Assembled, (observer_cls, *observer_args)
+
+    return observer_cls, observer_args
+
+
+def _supported(cls, options):
+    parameters = inspect.signature(cls).parameters
+    return {k: v for k, v in options.items() if k in parameters}
+
+
+class _Sink(Observer):
+    def on_batch(self, objects):
+        pass
+
+
+def calibrate(count=2000, backends=AUTO_BACKENDS):
+    """Measure the push cost and the consumer throughput of each backend on this machine
+
+    The async backend is not measured, it needs to run inside an event loop.
+
+    Returns
+    -------
+    ``{backend: dict(push=seconds per push, throughput=objects per second)}``,
+    the throughput is the sustained rate, from the first push until everything was delivered
+
+    """
+    results = {}
+
+    for backend in backends:
+        observer_cls, observer_args = _adapt(backend, _Sink, ())
+
+        # large enough to never drop, a dropped event is cheaper than a delivered one
+        with backend_class(backend)(observer_cls, observer_args, 4 * count) as counter:
+            start = time.perf_counter()
+            for i in range(count):
+                counter.push_object(name="bench", step=i)
+            pushed = time.perf_counter()
+
+            counter.wait()
+            end = time.perf_counter()
+
+        results[backend] = dict(
+            push=(pushed - start) / count,
+            throughput=count / (end - start),
+        )
+
+    return results
+
+
+_calibration = None
+
+
+def calibration():
+    """Calibration results, measured once per process"""
+    global _calibration
+
+    if _calibration is None:
+        _calibration = calibrate()
+
+    return _calibration
+
+
+def select_backend(rate=None, results=None):
+    """Cheapest backend to push to that keeps up with ``rate`` objects per second
+
+    If none can keep up, the backend with the highest throughput is selected
+    """
+    if results is None:
+        results = calibration()
+
+    fast_enough = [
+        backend
+        for backend, result in results.items()
+        if rate is None or result["throughput"] >= rate
+    ]
+
+    if not fast_enough:
+        return max(results, key=lambda backend: results[backend]["throughput"])
+
+    return min(fast_enough, key=lambda backend: results[backend]["push"])
+
+
+def PerfCounter(observer_cls, observer_args=(), backend="auto", rate=None, **options):
+    """Make a perf counter using the given backend
+
+    Parameters
+    ----------
+    observer_cls:
+        Observer receiving the pushed objects, see :class:`Observer`
+
+    backend: str
+        ``thread``, ``queue``, ``shm``, ``async`` or ``auto``.
+        ``auto`` runs a short microbenchmark the first time it is used
+        and selects the cheapest backend that keeps up with ``rate``, see :func:`select_backend`;
+        it only selects from :data:`AUTO_BACKENDS`.
+        The async backend must be used with ``async with``
+
+    rate: float
+        Expected number of objects pushed per second
+
+    options:
+        Backend specific arguments (``size``, ``backpressure``, ``spsc``, ...),
+        with ``auto`` the arguments the selected backend does not support are ignored
+
+    """
+    if backend == "auto":
+        backend = select_backend(rate)
+        cls = backend_class(backend)
+        options = _supported(cls, options)
+    else:
+        cls = backend_class(backend)
+
+    observer_cls, observer_args = _adapt(backend, observer_cls, observer_args)
+    return cls(observer_cls, observer_args, **options)
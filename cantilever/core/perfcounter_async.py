@@ -0,0 +1,276 @@
+import asyncio
+import inspect
+import time
+import traceback
+from collections import deque
+
+from .backoff import check_policy, keep_sample
+
+# Observer, ObjectAssembler, Source and the exceptions are shared by all the backends
+from .perfcounter import (
+    STATE_CPU_TIME,
+    STATE_DROPPED,
+    STATE_HIGH_WATER,
+    STATE_ON,
+    STATE_OVERWRITTEN,
+    Backpressure,
+    MessageBatching,
+    NotInitialized,
+    ObjectAssembler,
+    Observer,
+    Reservation,
+    RxSource,
+    Source,
+    WorkerStopped,
+    _count,
+    my_perf_counter,
+    read_counters,
+)
+
+# Maximum number of messages delivered to the observer before yielding to the event loop
+MAX_BATCH = 4096
+
+
+async def _dispatch(observer, msg):
+    # batches pushed with push_many/commit are sent as a single list
+    if isinstance(msg, list):
+        for obj in msg:
+            await _dispatch(observer, obj)
+        return
+
+    try:
+        result = observer(msg)
+        if inspect.isawaitable(result):
+            await result
+    except Exception:
+        traceback.print_exc()
+
+
+async def _dispatch_batch(observer, messages):
+    # flatten the batches pushed with push_many/commit
+    batch = []
+    for msg in messages:
+        if isinstance(msg, list):
+            batch.extend(msg)
+        else:
+            batch.append(msg)
+
+    try:
+        result = observer.on_batch(batch)
+        if inspect.isawaitable(result):
+            await result
+    except Exception:
+        traceback.print_exc()
+
+
+async def _worker(counter, observer_cls, observer_args, state):
+    messages = counter.messages
+    doorbell = counter.doorbell
+    delivered = counter.delivered
+
+    async def deliver(batch):
+        # the observer runs on the event loop thread, only count the time spent in it
+        start = time.thread_time()
+        try:
+            if on_batch is not None:
+                await _dispatch_batch(observer, batch)
+                return
+
+            for msg in batch:
+                await _dispatch(observer, msg)
+        finally:
+            state[STATE_CPU_TIME] += time.thread_time() - start
+
+    high_water = 0
+
+    def track_high_water(depth):
+        nonlocal high_water
+
+        if depth > high_water:
+            high_water = depth
+            state[STATE_HIGH_WATER] = depth
+
+    async def event_loop():
+        # read before draining, everything pushed before the exit is delivered
+        closing = counter.closing
+
+        if messages:
+            depth = len(messages)
+            track_high_water(depth)
+
+            popleft = messages.popleft
+            batch = [popleft() for _ in range(min(depth, MAX_BATCH))]
+
+            await deliver(batch)
+
+            counter.taken += len(batch)
+            async with delivered:
+                delivered.notify_all()
+
+            # let the producers run between two batches
+            await asyncio.sleep(0)
+            return True
+
+        if closing:
+            return False
+
+        counter.sleeping = True
+        doorbell.clear()
+        try:
+            await doorbell.wait()
+        finally:
+            counter.sleeping = False
+
+        return True
+
+    # worker turned on
+    state[STATE_ON] = 1
+
+    try:
+        observer = observer_cls(*observer_args)
+        observer.counters = lambda: read_counters(state)
+        on_batch = getattr(observer, "on_batch", None)
+
+        with observer:
+            counter.ready.set()
+
+            while True:
+                if not await event_loop():
+                    break
+
+    except Exception:
+        traceback.print_exc()
+
+    finally:
+        state[STATE_ON] = 0
+        counter.ready.set()
+
+        # release wait(), what is left is dropped
+        while messages:
+            state[STATE_DROPPED] += _count(messages.popleft())
+            counter.taken += 1
+
+        async with delivered:
+            delivered.notify_all()
+
+
+class PerfCounter(MessageBatching):
+    """Send events to an observer running as a task on the current event loop
+
+    ``push_object`` never blocks, it appends to a deque and wakes up the observer task if it is sleeping.
+    The observer task drains the deque in batches; its methods can be coroutines.
+
+    .. code-block:: python
+
+       async with PerfCounter(Source, (handler,)) as counter:
+           counter.push_object(name="batch", time=time.time_ns(), batch_size=1024)
+
+    Parameters
+    ----------
+    size: int
+        Maximum number of messages waiting to be delivered
+
+    backpressure: str
+        ``raise``, ``drop``, ``overwrite`` or ``sample``, pushing cannot block the event loop
+
+    """
+
+    def __init__(
+        self,
+        observer_cls,
+        observer_args,
+        size=20000,
+        backpressure="drop",
+    ):
+        if check_policy(backpressure) == "block":
+            raise ValueError("push_object cannot block the event loop")
+
+        self.observer_cls = observer_cls
+        self.observer_args = observer_args
+        self.size = size
+        self.backpressure = backpressure
+        self.state = {
+            STATE_ON: 0,
+            STATE_CPU_TIME: 0,
+            STATE_DROPPED: 0,
+            STATE_OVERWRITTEN: 0,
+            STATE_HIGH_WATER: 0,
+        }
+        self.messages = deque()
+        self.pushed = 0
+        self.taken = 0
+        self.sleeping = False
+        self.closing = False
+        self.doorbell = None
+        self.delivered = None
+        self.ready = None
+        self.worker = None
+        self.consumer_cpu_time = None
+        self.final_counters = None
+
+    async def __aenter__(self):
+        # the asyncio primitives are bound to the running loop
+        self.doorbell = asyncio.Event()
+        self.delivered = asyncio.Condition()
+        self.ready = asyncio.Event()
+
+        self.worker = asyncio.create_task(
+            _worker(self, self.observer_cls, self.observer_args, self.state)
+        )
+        await self.ready.wait()
+        return self
+
+    def _delivered(self):
+        return self.taken >= self.pushed or self.state[STATE_ON] == 0
+
+    async def wait(self):
+        """Wait until everything pushed so far was delivered"""
+        async with self.delivered:
+            await self.delivered.wait_for(self._delivered)
+
+    async def __aexit__(self, *args):
+        self.closing = True
+        self.doorbell.set()
+
+        await self.worker
+        self.consumer_cpu_time = self.state[STATE_CPU_TIME]
+        self.final_counters = read_counters(self.state)
+
+    def push_object(self, **kwargs):
+        if self.state[STATE_ON] == 0:
+            raise WorkerStopped()
+
+        self._put(kwargs)
+
+    def counters(self):
+        """Backpressure counters, dropped and overwritten are in number of objects"""
+        if self.final_counters is not None:
+            return self.final_counters
+
+        return read_counters(self.state)
+
+    def _put(self, msg):
+        messages = self.messages
+        policy = self.backpressure
+        depth = len(messages)
+
+        if policy == "sample" and not keep_sample(depth, self.size):
+            self.state[STATE_DROPPED] += _count(msg)
+            return
+
+        if depth >= self.size:
+            if policy == "raise":
+                raise Backpressure()
+
+            if policy != "overwrite":
+                self.state[STATE_DROPPED] += _count(msg)
+                return
+
+            self.state[STATE_OVERWRITTEN] += _count(messages.popleft())
+            self.pushed -= 1
+
+        messages.append(msg)
+        self.pushed += 1
+
+        if self.sleeping:
+            self.doorbell.set()
@@ -1,53 +1,141 @@
 import multiprocessing
-from multiprocessing import Manager
-import time
 import queue
+import threading
+import time
 import traceback
+from multiprocessing import Manager
 
-SHM_INDEX_IN = -1
-SHM_INDEX_OUT = -2
-SHM_ON = -3
-SHM_SIZE = -4
-SHM_MAX = 4
+from .backoff import AdaptiveWait, check_policy, keep_sample
+
+# Observer, ObjectAssembler, Source and the exceptions are shared by all the backends
+from .perfcounter import (
+    STATE_CPU_TIME,
+    STATE_DROPPED,
+    STATE_HIGH_WATER,
+    STATE_MAX,
+    STATE_ON,
+    STATE_OVERWRITTEN,
+    Backpressure,
+    MessageBatching,
+    NotInitialized,
+    ObjectAssembler,
+    Observer,
+    Reservation,
+    RxSource,
+    Source,
+    WorkerStopped,
+    _count,
+    _dispatch,
+    _dispatch_batch,
+    my_perf_counter,
+    read_counters,
+)
+
+# Maximum number of messages drained before they are delivered to the observer
+MAX_BATCH = 4096
+
+# Sent by the producer on exit, the worker stops once everything before it was delivered
+STOP = None
+
+# How often ``wait()`` checks that the worker is still alive
+JOIN_POLL = 0.1
+
+
+def _qsize(buffer):
+    try:
+        return buffer.qsize()
+    except NotImplementedError:
+        # multiprocessing.Queue.qsize is not available on macOS
+        return 0
 
 
-class Observer:
-    def __init__(self) -> None:
-        pass
+def _discard(buffer, state, timeout=None):
+    # the worker is gone, release ``join()`` and count what is left as dropped
+    while True:
+        try:
+            if timeout is None:
+                msg = buffer.get_nowait()
+            else:
+                msg = buffer.get(timeout=timeout)
+        except queue.Empty:
+            return
+
+        if msg is not STOP:
+            state[STATE_DROPPED] += _count(msg)
+        buffer.task_done()
+
+
+def _worker(
+    buffer: multiprocessing.JoinableQueue, observer_cls, observer_args, state, waiter
+):
+    running = True
+
+    def sleep(timeout):
+        # the queue is the doorbell
+        try:
+            msg = buffer.get(timeout=timeout)
+        except queue.Empty:
+            return False
 
-    def __call__(self, key, value):
-        pass
+        deliver([msg])
+        return True
 
-    def __enter__(self):
-        return self
+    def deliver(messages):
+        nonlocal running
 
-    def __exit__(self, *args):
-        pass
+        done = len(messages)
+        if messages[-1] is STOP:
+            running = False
+            messages.pop()
 
+        if on_batch is not None:
+            if messages:
+                _dispatch_batch(observer, messages)
+        else:
+            for msg in messages:
+                _dispatch(observer, msg)
 
-def _worker(buffer: multiprocessing.Queue, observer_cls, observer_args, state):
-    def event_loop():
-        if state[SHM_ON] == 0:
-            return False
+        for _ in range(done):
+            buffer.task_done()
 
-        while True:
+    high_water = 0
+
+    def track_high_water():
+        nonlocal high_water
+
+        depth = _qsize(buffer)
+        if depth > high_water:
+            high_water = depth
+            state[STATE_HIGH_WATER] = depth
+
+    def event_loop():
+        messages = []
+        while len(messages) < MAX_BATCH:
             try:
                 msg = buffer.get_nowait()
-
-                observer(msg)
             except queue.Empty:
-                return True
+                break
 
-            except Exception:
-                traceback.print_exc()
+            if not messages:
+                track_high_water()
 
-        return True
+            messages.append(msg)
+
+        if messages:
+            waiter.reset()
+            deliver(messages)
+        else:
+            waiter.idle(sleep)
+
+        return running
 
     # worker turned on
-    state[SHM_ON] = 1
+    state[STATE_ON] = 1
 
     try:
         observer = observer_cls(*observer_args)
+        observer.counters = lambda: read_counters(state)
+        on_batch = getattr(observer, "on_batch", None)
 
         with observer:
             while True:
@@ -58,124 +146,305 @@ def _worker(buffer: multiprocessing.Queue, observer_cls, observer_args, state):
         traceback.print_exc()
 
     finally:
-        state[SHM_ON] = 0
-
-
-class NotInitialized(Exception):
-    pass
-
-
-class Backpressure(Exception):
-    pass
-
-
-class WorkerStopped(Exception):
-    pass
-
-
-class PerfCounter:
-    def __init__(self, observer_cls, observer_args, size=20000):
-        self.smm = Manager()
-        self.queue = self.smm.Queue(size)
-        self.state = self.smm.dict()
+        state[STATE_ON] = 0
+        state[STATE_CPU_TIME] = time.process_time()
+        _discard(buffer, state)
+
+
+class PerfCounter(MessageBatching):
+    """Send events to an observer running in a separate process
+
+    Events are buffered by the producer and sent as a single pickled message once
+    ``batch_size`` events are pending or the oldest pending event is ``batch_age`` seconds old.
+    The flags and counters shared with the worker live in a raw shared array,
+    checking them does not require a round-trip to another process.
+
+    The worker blocks on the queue while there is nothing to do,
+    it stops as soon as everything pushed before the exit was delivered.
+
+    Parameters
+    ----------
+    size: int
+        Maximum number of messages (i.e. batches) in flight
+
+    batch_size: int
+        Number of events sent together, ``1`` sends each event as soon as it is pushed
+
+    batch_age: float
+        Maximum time in seconds an event can wait in the producer buffer,
+        a background thread sends the pending events once the oldest is that old
+
+    """
+
+    def __init__(
+        self,
+        observer_cls,
+        observer_args,
+        size=20000,
+        waiter=None,
+        backpressure="drop",
+        block_timeout=0.01,
+        batch_size=64,
+        batch_age=0.01,
+    ):
+        self.queue = None
+        self.state = None
         self.worker = None
         self.size = size
         self.observer_cls = observer_cls
         self.observer_args = observer_args
-        self.worker = None
+        # block until something is pushed, no polling
+        self.waiter = waiter or AdaptiveWait(spin=0, yields=0, timeout=None)
+        self.consumer_cpu_time = None
+        self.backpressure = check_policy(backpressure)
+        self.block_timeout = block_timeout
+        self.batch_size = max(batch_size, 1)
+        self.batch_age = batch_age
+        self.pending = []
+        self.pending_since = 0
+        self.lock = threading.Lock()
+        # wakes up the idle flusher when the first event is buffered
+        self.aging = threading.Condition(self.lock)
+        self.flusher = None
+        self.flusher_idle = False
+        self.closing = False
+        self.final_counters = None
+        # the worker died without turning STATE_ON off (killed, crashed)
+        self.lost = False
+
+    def _make_queue(self):
+        self.queue = multiprocessing.JoinableQueue(self.size)
+        self.state = multiprocessing.RawArray("d", STATE_MAX)
 
     def __enter__(self):
-        # self.smm.start()
+        self._make_queue()
         self._init_worker()
+
+        if self.batch_size > 1:
+            self.flusher = threading.Thread(target=self._flush_aged, daemon=True)
+            self.flusher.start()
         return self
 
     def _init_worker(self):
-        self.state[SHM_ON] = 0
+        self.state[STATE_ON] = 0
+        self.state[STATE_DROPPED] = 0
+        self.state[STATE_OVERWRITTEN] = 0
+        self.state[STATE_HIGH_WATER] = 0
         self.worker = multiprocessing.Process(
             target=_worker,
-            args=(self.queue, self.observer_cls, self.observer_args, self.state),
+            args=(
+                self.queue,
+                self.observer_cls,
+                self.observer_args,
+                self.state,
+                self.waiter,
+            ),
         )
         self.worker.start()
         self._wait_worker_init()
 
     def _wait_worker_init(self):
-        while not self.state[SHM_ON]:
+        while not self.state[STATE_ON]:
             time.sleep(0.1)
 
     def wait(self):
-        while not self.queue.empty():
-            time.sleep(0.1)
+        """Wait until everything pushed so far was delivered"""
+        self.flush()
+
+        # polled, a worker dying during the wait would never mark the remaining messages done
+        while not self._join(JOIN_POLL):
+            if not self.worker.is_alive():
+                self.lost = True
+                _discard(self.queue, self.state, timeout=JOIN_POLL)
+                return
+
+    def _join(self, timeout):
+        # JoinableQueue.join() with a timeout, true once every message was delivered
+        buffer = self.queue
+        with buffer._cond:
+            if not buffer._unfinished_tasks._semlock._is_zero():
+                buffer._cond.wait(timeout)
+
+            return buffer._unfinished_tasks._semlock._is_zero()
+
+    def _stop(self):
+        if self.flusher is not None:
+            with self.lock:
+                self.closing = True
+                self.aging.notify()
+
+            self.flusher.join()
+
+        self.flush()
+
+        # the stop message cannot be dropped, unless the worker is already gone
+        while self.worker.is_alive():
+            try:
+                self.queue.put(STOP, timeout=self.block_timeout)
+                break
+            except queue.Full:
+                pass
 
-    def __exit__(self, *args):
-        self.wait()
-        self.state[SHM_ON] = 0
         self.worker.join()
-        return self.smm.__exit__(*args)
+        self.consumer_cpu_time = self.state[STATE_CPU_TIME]
+        self.final_counters = read_counters(self.state)
+
+    def __exit__(self, *args):
+        self._stop()
+
+        if self.state[STATE_ON]:
+            # nobody reads the pipe anymore, the feeder thread would never finish
+            _discard(self.queue, self.state, timeout=0.1)
+            self.queue.cancel_join_thread()
+            self.final_counters = read_counters(self.state)
+
+        self.queue.close()
+        self.queue.join_thread()
+
+    def _running(self):
+        return not self.lost and self.state[STATE_ON] != 0
 
     def push_object(self, **kwargs):
-        if self.state[SHM_ON] == 0:
+        if not self._running():
             raise WorkerStopped()
 
-        self.queue.put_nowait(kwargs)
+        # the producer threads share the pending batch
+        with self.lock:
+            pending = self.pending
+            if not pending:
+                self.pending_since = time.perf_counter()
+                if self.flusher_idle:
+                    self.aging.notify()
+
+            pending.append(kwargs)
+
+            if (
+                len(pending) < self.batch_size
+                and time.perf_counter() - self.pending_since < self.batch_age
+            ):
+                return
+
+            self.pending = []
+
+        self._send(pending)
+
+    def flush(self):
+        """Send the pending events"""
+        with self.lock:
+            pending, self.pending = self.pending, []
+
+        if pending:
+            self._send(pending)
+
+    def _flush_aged(self):
+        # runs in the flusher thread, sends the events that waited batch_age
+        # when nothing is pushed to trigger the check
+        with self.aging:
+            while not self.closing:
+                if not self.pending:
+                    self.flusher_idle = True
+                    self.aging.wait()
+                    self.flusher_idle = False
+                    continue
+
+                remaining = self.pending_since + self.batch_age - time.perf_counter()
+                if remaining > 0:
+                    self.aging.wait(remaining)
+                    continue
+
+                # sent with the lock held, a producer cannot send newer events first
+                pending, self.pending = self.pending, []
+                try:
+                    self._send(pending)
+                except queue.Full:
+                    # raise policy, there is nobody to raise to in this thread
+                    self._drop(pending)
+
+    def _send(self, pending):
+        if not self.worker.is_alive():
+            # checked once per batch, a dead worker cannot turn STATE_ON off itself
+            self.lost = True
+            self._drop(pending)
+            return
+
+        if len(pending) == 1:
+            self._put(pending[0])
+        else:
+            self._put(pending)
 
+    def _put_many(self, objects):
+        # keep the events in order
+        self.flush()
+        self._send(objects)
 
-my_perf_counter = time.perf_counter_ns
+    def counters(self):
+        """Backpressure counters, dropped and overwritten are in number of objects"""
+        if self.final_counters is not None:
+            return self.final_counters
 
+        return read_counters(self.state)
 
-class ObjectAssembler(Observer):
-    def __init__(self) -> None:
-        pass
+    def _put(self, msg):
+        policy = self.backpressure
 
-    def __enter__(self):
-        return self
+        if policy == "sample" and not keep_sample(_qsize(self.queue), self.size):
+            self._drop(msg)
+            return
 
-    def __exit__(self, *args):
-        return
+        try:
+            if policy == "block":
+                self.queue.put(msg, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(msg)
+            return
 
-    def push(self, object):
-        pass
+        except queue.Full:
+            if policy == "raise":
+                raise
 
-    def __call__(self, obj):
-        self.push(obj)
+        if policy == "overwrite":
+            self._overwrite(msg)
+        else:
+            self._drop(msg)
 
+    def _overwrite(self, msg):
+        try:
+            # the messages might still be in the feeder thread, do not use get_nowait
+            oldest = self.queue.get(timeout=self.block_timeout)
+            self.queue.task_done()
+            self.state[STATE_OVERWRITTEN] += _count(oldest)
+        except queue.Empty:
+            pass
 
-class Source(ObjectAssembler):
-    def __init__(self, handler) -> None:
-        super().__init__()
-        self.reactivex_observer = None
-        self.reactivex_scheduler = None
-        self.source = None
-        self.handler = handler
-        self.pending = []
+        try:
+            self.queue.put_nowait(msg)
+        except queue.Full:
+            self._drop(msg)
 
-    def __enter__(self):
-        def make(observer, scheduler):
-            self.reactivex_observer = observer
-            self.reactivex_scheduler = scheduler
+    def _drop(self, msg):
+        self.state[STATE_DROPPED] += _count(msg)
 
-        import reactivex as rx
 
-        self.source = rx.create(make)
-        self.handler(
-            self.source,
-            lambda: self.reactivex_observer,
-            lambda: self.reactivex_scheduler,
-        )
-        return self
+class ManagerPerfCounter(PerfCounter):
+    """Previous implementation, the queue and the shared state are proxies to a manager process.
 
-    def __exit__(self, *args):
-        if self.reactivex_observer:
-            self.reactivex_observer.on_completed()
-        else:
-            raise RuntimeError("reactivex_observer was never set")
-        return
+    Every push and every flag check is a round-trip to the manager, kept for comparison.
+    """
 
-    def push(self, object):
-        if self.reactivex_observer:
-            if self.pending:
-                for obj in self.pending:
-                    self.reactivex_observer.on_next(obj)
+    def __init__(self, *args, batch_size=1, **kwargs):
+        super().__init__(*args, batch_size=batch_size, **kwargs)
+        self.smm = None
 
-            self.reactivex_observer.on_next(object)
-        else:
-            self.pending.append(object)
+    def _make_queue(self):
+        self.smm = Manager()
+        self.queue = self.smm.Queue(self.size)
+        self.state = self.smm.dict()
+
+    def _join(self, timeout):
+        # the proxy does not expose the number of unfinished tasks
+        self.queue.join()
+        return True
+
+    def __exit__(self, *args):
+        self._stop()
+        return self.smm.__exit__(*args)
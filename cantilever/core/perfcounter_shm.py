@@ -1,17 +1,67 @@
+import glob
+import itertools
+import mmap
 import multiprocessing
-from multiprocessing.shared_memory import ShareableList
-from multiprocessing.managers import SharedMemoryManager
+import numbers
+import os
+import platform
+import struct
+import threading
 import time
 import traceback
+import warnings
+from contextlib import nullcontext
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+from .backoff import AdaptiveWait, check_policy, keep_sample
+from .perfcounter import Backpressure, NotInitialized
+from .perfcounter import RxSource as ObjectRxSource
+from .perfcounter import Source as ObjectSource
+from .perfcounter import WorkerStopped
 
 SHM_INDEX_IN = -1
 SHM_INDEX_OUT = -2
 SHM_ON = -3
 SHM_SIZE = -4
-SHM_MAX = 4
+SHM_KEY_SIZE = -5
+SHM_KEY_COUNT = -6
+SHM_MAX_KEYS = -7
+SHM_SLEEPING = -8
+SHM_CPU_TIME = -9
+SHM_DROPPED = -10
+SHM_OVERWRITTEN = -11
+SHM_HIGH_WATER = -12
+SHM_VALUE_SIZE = -13
+SHM_RECORD_ID = -14
+SHM_WRITE_END = -15
+SHM_MAX = 15
+
+# Each header word lives on its own cache line so the producer and the consumer
+# never write to the same line
+CACHE_LINE = 64
+HEADER_STRIDE = CACHE_LINE // 8
+
+my_perf_counter = time.perf_counter_ns
+
+# The lock-free paths (spsc mode, the end of write announced in overwrite mode) rely on
+# the store/store and load/load ordering of x86-64, weaker memory models can reorder them
+ORDERED_STORES = platform.machine().lower() in ("x86_64", "amd64")
+
+_counter_ids = itertools.count()
+
+SHM_PREFIX = "cantilever_"
+SHM_ROOT = "/dev/shm"
+
+# shared memory blocks created by this process
+_owned = set()
 
 
 class Observer:
+    """Receive the key/value records written to the ring,
+    use :class:`Assembled` to receive objects like the other backends
+    """
+
     def __init__(self) -> None:
         pass
 
@@ -24,17 +74,715 @@ class Observer:
     def __exit__(self, *args):
         pass
 
+    def counters(self):
+        """Backpressure counters, replaced by a live view when running inside the worker"""
+        return dict(dropped=0, overwritten=0, high_water=0)
+
+
+class KeyTableFull(ValueError):
+    """Every slot of the key table is taken, objects with a new key cannot be written"""
+
+
+def read_counters(header):
+    return dict(
+        dropped=header[SHM_DROPPED],
+        overwritten=header[SHM_OVERWRITTEN],
+        high_water=header[SHM_HIGH_WATER],
+    )
+
+
+VALUE_INT = 0
+VALUE_STR = 1
+VALUE_FLOAT = 2
+VALUE_BOOL = 3
+VALUE_BYTES = 4
+VALUE_HEADER = 5
+VALUE_SIZE = 32
+
+# raised by RingLayout for a field it cannot store: unsupported type, value or key too big,
+# key table full, integer out of the int64 range
+WRITE_ERRORS = (ValueError, TypeError, struct.error)
+
+# key id of the header records, never handed out by the key table
+HEADER_KEY = 0xFFFFFFFF
+
+# timestamp, key id, tag then pad so the value is aligned on 8 bytes
+RECORD_PREFIX = "<qIB3x"
+
+# str and bytes use the padding to store their length
+RECORD_PREFIX_SIZED = "<qIBxH"
+
+
+def _record_size(value_size):
+    return struct.calcsize(f"{RECORD_PREFIX_SIZED}{max(value_size, 8)}s0q")
+
+
+def value_tag(value):
+    """Returns the tag of the slot used to store value"""
+    kind = type(value)
+
+    # exact matches first, they are the most common
+    if kind is int:
+        return VALUE_INT
+    if kind is float:
+        return VALUE_FLOAT
+    if kind is str:
+        return VALUE_STR
+    if kind is bool:
+        return VALUE_BOOL
+    if kind is bytes:
+        return VALUE_BYTES
+
+    # numpy scalars & co
+    if isinstance(value, numbers.Integral):
+        return VALUE_INT
+    if isinstance(value, numbers.Real):
+        return VALUE_FLOAT
+    if isinstance(value, (bytearray, memoryview)):
+        return VALUE_BYTES
+
+    raise TypeError(f"Unsupported value type {kind}")
+
+
+class RingLayout:
+    """Ring of fixed-width records stored in a raw shared memory block
+
+    .. code-block:: text
+
+        | header: SHM_MAX x int64 | keys: max_keys x bytes[key_size] | record 0 | ... | record size - 1 |
+
+    The header is indexed with the ``SHM_*`` constants, every word is 64-bit
+    aligned and padded to a full cache line.
+
+    Keys are interned, the producer registers a key once in the key table
+    and publishes it by incrementing ``SHM_KEY_COUNT``; records only carry the key id.
+    The consumer resolves ids through a local copy of the table.
+
+    A record is ``(timestamp: int64, key_id: uint32, tag: uint8, value)``,
+    the tag selects how the value is interpreted: int64, float64, bool
+    or up to ``value_size`` bytes of str/bytes (their length is stored in the padding).
+    Records are written and read in place with precompiled ``struct.Struct``
+    so no intermediate python list is involved.
+
+    Objects are framed: a header record (tag ``VALUE_HEADER``, key ``HEADER_KEY``)
+    holding the number of fields in the length slot and the record id as value
+    is followed by one record per field.
+    Record ids are consecutive, a gap means objects were overwritten.
+    """
+
+    header_size = SHM_MAX * CACHE_LINE
+
+    def __init__(self, buf, size, key_size, max_keys, value_size=VALUE_SIZE):
+        self.buf = buf
+        self.size = size
+        self.key_size = key_size
+        self.max_keys = max_keys
+        self.value_size = value_size
+
+        self.key_struct = struct.Struct(f"{key_size}s")
+        self.key_ids = dict()
+        self.keys = []
+
+        self.tag_offset = 12
+        self.value_offset = 16
+        self.codecs = {
+            VALUE_INT: struct.Struct(f"{RECORD_PREFIX}q"),
+            VALUE_FLOAT: struct.Struct(f"{RECORD_PREFIX}d"),
+            VALUE_BOOL: struct.Struct(f"{RECORD_PREFIX}?"),
+            VALUE_STR: struct.Struct(f"{RECORD_PREFIX_SIZED}{value_size}s"),
+            VALUE_BYTES: struct.Struct(f"{RECORD_PREFIX_SIZED}{value_size}s"),
+            VALUE_HEADER: struct.Struct(f"{RECORD_PREFIX_SIZED}q"),
+        }
+        self.sized_header = struct.Struct(RECORD_PREFIX_SIZED)
+        self.record_size = _record_size(value_size)
+        self.records_offset = self.header_size + max_keys * key_size
+        self.header = buf[: self.header_size].cast("q")[::HEADER_STRIDE]
+
+    @classmethod
+    def nbytes(cls, size, key_size, max_keys, value_size=VALUE_SIZE):
+        record_size = _record_size(value_size)
+        return cls.header_size + max_keys * key_size + size * record_size
+
+    @classmethod
+    def create(cls, buf, size, key_size, max_keys, value_size=VALUE_SIZE):
+        nbytes = cls.nbytes(size, key_size, max_keys, value_size)
+        buf[:nbytes] = bytes(nbytes)
+        self = cls(buf, size, key_size, max_keys, value_size)
+        self.header[SHM_SIZE] = size
+        self.header[SHM_KEY_SIZE] = key_size
+        self.header[SHM_MAX_KEYS] = max_keys
+        self.header[SHM_VALUE_SIZE] = value_size
+        return self
+
+    @classmethod
+    def attach(cls, buf):
+        header = buf[: cls.header_size].cast("q")[::HEADER_STRIDE]
+        size, key_size, max_keys, value_size = (
+            header[SHM_SIZE],
+            header[SHM_KEY_SIZE],
+            header[SHM_MAX_KEYS],
+            header[SHM_VALUE_SIZE],
+        )
+        header.release()
+        return cls(buf, size, key_size, max_keys, value_size)
+
+    def offset(self, counter):
+        return self.records_offset + (counter % self.size) * self.record_size
+
+    def register(self, key):
+        """Add a key to the shared key table, only the producer registers keys"""
+        data = key.encode()
+
+        if len(data) > self.key_size:
+            raise ValueError("Key is bigger than storage")
+
+        key_id = self.header[SHM_KEY_COUNT]
+        if key_id >= self.max_keys:
+            raise KeyTableFull("Key table is full")
+
+        self.key_struct.pack_into(
+            self.buf, self.header_size + key_id * self.key_size, data
+        )
+        # publish the key once it is fully written
+        self.header[SHM_KEY_COUNT] = key_id + 1
+        self.key_ids[key] = key_id
+        return key_id
+
+    def refresh_keys(self):
+        """Copy the keys registered since the last refresh, only the consumer refreshes keys"""
+        keys = self.keys
+
+        for i in range(len(keys), self.header[SHM_KEY_COUNT]):
+            (data,) = self.key_struct.unpack_from(
+                self.buf, self.header_size + i * self.key_size
+            )
+            keys.append(data.rstrip(b"\0").decode())
+
+    def resolve(self, key_id):
+        """Return the key from its id, only the consumer resolves keys"""
+        keys = self.keys
+
+        if key_id >= len(keys):
+            self.refresh_keys()
+
+        return keys[key_id]
+
+    def write(self, counter, key, value):
+        key_id = self.key_ids.get(key)
+
+        if key_id is None:
+            key_id = self.register(key)
+
+        tag = value_tag(value)
+        offset = self.offset(counter)
+
+        if tag == VALUE_STR or tag == VALUE_BYTES:
+            if tag == VALUE_STR:
+                value = value.encode()
+
+            if len(value) > self.value_size:
+                raise ValueError("Value is bigger than storage")
+
+            self.codecs[tag].pack_into(
+                self.buf, offset, my_perf_counter(), key_id, tag, len(value), value
+            )
+            return
+
+        self.codecs[tag].pack_into(
+            self.buf, offset, my_perf_counter(), key_id, tag, value
+        )
+
+    def write_header(self, counter, count):
+        """Write the header of an object of ``count`` fields, only the producer writes headers"""
+        if count > 0xFFFF:
+            raise ValueError("Too many fields")
+
+        record_id = self.header[SHM_RECORD_ID]
+        self.codecs[VALUE_HEADER].pack_into(
+            self.buf,
+            self.offset(counter),
+            my_perf_counter(),
+            HEADER_KEY,
+            VALUE_HEADER,
+            count,
+            record_id,
+        )
+        self.header[SHM_RECORD_ID] = record_id + 1
+
+    def write_object(self, counter, obj):
+        """Write the fields then the header of ``obj``, returns the index following the object.
+        An object that fails half-way does not get a header nor consume a record id
+        """
+        index = counter
+        for k, v in obj.items():
+            index += 1
+            self.write(index, k, v)
+
+        self.write_header(counter, len(obj))
+        return index + 1
+
+    def read(self, counter):
+        return self.decode(self.buf, self.offset(counter))
+
+    def read_header(self, buf, offset):
+        """Returns ``(timestamp, count, record_id)`` of the header stored at ``offset``"""
+        timestamp, _, _, count, record_id = self.codecs[VALUE_HEADER].unpack_from(
+            buf, offset
+        )
+        return timestamp, count, record_id
+
+    def decode(self, buf, offset):
+        """Decode the record stored at ``offset`` in ``buf`` (the ring or a chunk of it)"""
+        tag = buf[offset + self.tag_offset]
+
+        if tag == VALUE_STR or tag == VALUE_BYTES:
+            timestamp, key_id, _, length = self.sized_header.unpack_from(buf, offset)
+
+            start = offset + self.value_offset
+            if tag == VALUE_STR:
+                value = str(buf[start : start + length], "utf-8")
+            else:
+                value = bytes(buf[start : start + length])
+        else:
+            timestamp, key_id, _, value = self.codecs[tag].unpack_from(buf, offset)
+
+        return timestamp, self.resolve(key_id), value
+
+    def chunks(self, start, end):
+        """Records ``[start, end)`` as at most two contiguous views of the ring,
+        the second one is only present when the records wrap around
+        """
+        first = start % self.size
+        count = end - start
+        base = self.records_offset
+        rs = self.record_size
+
+        if first + count <= self.size:
+            return [self.buf[base + first * rs : base + (first + count) * rs]]
+
+        wrapped = first + count - self.size
+        return [
+            self.buf[base + first * rs : base + self.size * rs],
+            self.buf[base : base + wrapped * rs],
+        ]
+
+    def numpy_dtype(self):
+        """Structured dtype of a record, the value fields overlap.
+        Headers have ``key == HEADER_KEY``, the field count in ``length`` and the record id in ``int``
+        """
+        import numpy as np
+
+        fields = [
+            ("timestamp", "<i8", 0),
+            ("key", "<u4", 8),
+            ("tag", "u1", self.tag_offset),
+            ("length", "<u2", 14),
+            ("int", "<i8", self.value_offset),
+            ("float", "<f8", self.value_offset),
+            ("bool", "?", self.value_offset),
+            ("bytes", f"S{self.value_size}", self.value_offset),
+        ]
+        return np.dtype(
+            {
+                "names": [name for name, _, _ in fields],
+                "formats": [fmt for _, fmt, _ in fields],
+                "offsets": [offset for _, _, offset in fields],
+                "itemsize": self.record_size,
+            }
+        )
+
+    def release(self):
+        # exported views need to be released before the memory can be closed
+        self.header.release()
+
+
+class FileSegment:
+    """Memory block backed by a memory mapped file, the records it holds
+    survive the crash of both the producer and the worker.
+    Mirrors the part of :class:`SharedMemory` used by the ring.
+    """
+
+    def __init__(self, name, size=0, create=False, readonly=False):
+        self.name = name
+
+        if readonly:
+            self.fp = open(name, "rb")
+            self.mmap = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.fp = open(name, "w+b" if create else "r+b")
+
+            if create:
+                self.fp.truncate(size)
+
+            self.mmap = mmap.mmap(self.fp.fileno(), 0)
+
+        self.buf = memoryview(self.mmap)
+
+    def close(self):
+        self.buf.release()
+        self.mmap.close()
+        self.fp.close()
+
+    def unlink(self):
+        os.remove(self.name)
+
+
+def attach_shared_memory(name):
+    """Attach to a block created by another process.
+    The resource tracker of this process must not unlink it when this process exits
+    """
+    if name in _owned:
+        # created by this process (or the process we were forked from),
+        # it is already tracked
+        return SharedMemory(name)
+
+    try:
+        # python >= 3.13
+        return SharedMemory(name, track=False)
+    except TypeError:
+        shm = SharedMemory(name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def discover(directories=()):
+    """Names of the rings of the PerfCounter running on this machine,
+    file backed rings are only found in the given directories
+    """
+    names = []
+
+    if os.path.isdir(SHM_ROOT):
+        names.extend(
+            sorted(n for n in os.listdir(SHM_ROOT) if n.startswith(SHM_PREFIX))
+        )
+
+    for directory in directories:
+        names.extend(sorted(glob.glob(os.path.join(directory, f"{SHM_PREFIX}*.ring"))))
+
+    return names
+
+
+class CounterView:
+    """Read-only view of the ring of a running PerfCounter, from any local process.
+    Nothing is written to the ring so the consumer is not disturbed.
+
+    .. code-block:: python
+
+       for name in discover():
+           with CounterView(name) as view:
+               print(view.stats())
+               print(view.records(10))
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+        if name.endswith(".ring"):
+            self.segment = FileSegment(name, readonly=True)
+        else:
+            self.segment = attach_shared_memory(name)
+
+        self.buf = self.segment.buf.toreadonly()
+        self.ring = RingLayout.attach(self.buf)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def stats(self):
+        header = self.ring.header
+        index_in, index_out = header[SHM_INDEX_IN], header[SHM_INDEX_OUT]
+
+        return dict(
+            name=os.path.basename(self.name),
+            pid=int(os.path.basename(self.name).split("_")[1]),
+            on=header[SHM_ON],
+            size=header[SHM_SIZE],
+            index_in=index_in,
+            index_out=index_out,
+            depth=max(index_in - index_out, 0),
+            keys=header[SHM_KEY_COUNT],
+            objects=header[SHM_RECORD_ID],
+            **read_counters(header),
+        )
+
+    def records(self, count=100):
+        """Fields among the last ``count`` records pushed, consumed or not,
+        as ``(timestamp, key, value)``
+        """
+        header = self.ring.header
+        index_in = header[SHM_INDEX_IN]
+        start = max(index_in - min(count, self.ring.size), 0)
+
+        # copy first, then discard what the producer might have overwritten during the copy
+        chunks = self.ring.chunks(start, index_in)
+        batch = RecordBatch(self.ring, [memoryview(bytes(c)) for c in chunks])
+        for chunk in chunks:
+            chunk.release()
+
+        batch.skip(header[SHM_INDEX_IN] - self.ring.size - start + 1)
+        try:
+            return list(batch)
+        finally:
+            batch.release()
+
+    def close(self):
+        self.ring.release()
+        self.buf.release()
+        self.segment.close()
+
+
+def replay(path, observer):
+    """Deliver the records a crashed worker did not consume to ``observer``.
+    Records are marked as consumed, replaying twice does nothing.
+    Returns the number of objects replayed.
+
+    .. code-block:: python
+
+       for path in glob.glob("/scratch/rings/*.ring"):
+           replay(path, ObjectAssembler())
+
+    """
+    segment = FileSegment(path)
+    ring = RingLayout.attach(segment.buf)
+    header = ring.header
+
+    try:
+        index_in = header[SHM_INDEX_IN]
+        counter = max(header[SHM_INDEX_OUT], index_in - ring.size)
+
+        on_batch = getattr(observer, "on_batch", None)
+        batch = RecordBatch(ring, ring.chunks(counter, index_in))
+
+        try:
+            count = sum(1 for _ in batch.frames())
+
+            with observer:
+                if on_batch is not None:
+                    on_batch(batch)
+                else:
+                    for _, key, value in batch:
+                        observer(key, value)
+        finally:
+            batch.release()
+
+        header[SHM_INDEX_OUT] = index_in
+        return count
+    finally:
+        ring.release()
+        segment.close()
+
+
+class RecordBatch:
+    """Contiguous records given to ``on_batch``.
+
+    ``chunks`` holds one memoryview per contiguous slice of the ring,
+    there are two when the records wrap around the end of the ring.
+    The views point inside the ring and are only valid during the ``on_batch`` call.
+
+    .. code-block:: python
+
+       class Mean(Observer):
+           def on_batch(self, batch):
+               for records in batch.numpy():
+                   values = records["float"][records["key"] == batch.key_id("loss")]
+    """
+
+    def __init__(self, ring, chunks):
+        self.ring = ring
+        self.chunks = chunks
+
+    def __len__(self):
+        """Number of records, headers included"""
+        return sum(len(chunk) for chunk in self.chunks) // self.ring.record_size
+
+    def _slots(self):
+        record_size = self.ring.record_size
+
+        for chunk in self.chunks:
+            for offset in range(0, len(chunk), record_size):
+                yield chunk, offset
+
+    def __iter__(self):
+        """Yields the decoded ``(timestamp, key, value)`` of the fields, headers are skipped"""
+        decode = self.ring.decode
+        tag_offset = self.ring.tag_offset
+
+        for chunk, offset in self._slots():
+            if chunk[offset + tag_offset] != VALUE_HEADER:
+                yield decode(chunk, offset)
+
+    def frames(self):
+        """Yields ``(timestamp, record_id, fields)`` for every complete object,
+        ``fields`` holds the ``(chunk, offset)`` of its records, they are not decoded.
+        Fields preceding the first header belong to an object that was overwritten and are skipped.
+        """
+        read_header = self.ring.read_header
+        tag_offset = self.ring.tag_offset
+        slots = self._slots()
+
+        for chunk, offset in slots:
+            if chunk[offset + tag_offset] != VALUE_HEADER:
+                continue
+
+            timestamp, count, record_id = read_header(chunk, offset)
+            fields = list(itertools.islice(slots, count))
+
+            if len(fields) < count:
+                return
+
+            yield timestamp, record_id, fields
+
+    def objects(self, select=None):
+        """Yields the objects as dictionaries
+
+        Parameters
+        ----------
+        select:
+            ``select(key, value)`` receives the first field of each object,
+            when it returns false the other fields are skipped without being decoded
+
+        """
+        decode = self.ring.decode
+
+        for _, _, fields in self.frames():
+            if not fields:
+                yield {}
+                continue
+
+            _, key, value = decode(*fields[0])
+            if select is not None and not select(key, value):
+                continue
+
+            obj = {key: value}
+            for chunk, offset in fields[1:]:
+                _, key, value = decode(chunk, offset)
+                obj[key] = value
+
+            yield obj
+
+    def numpy(self):
+        """One NumPy structured array per chunk, no copy is made"""
+        import numpy as np
+
+        dtype = self.ring.numpy_dtype()
+        return [np.frombuffer(chunk, dtype=dtype) for chunk in self.chunks]
+
+    def key(self, key_id):
+        return self.ring.resolve(key_id)
+
+    def key_id(self, key):
+        """Key id used in the records, -1 if the key was never pushed"""
+        if key not in self.ring.keys:
+            self.ring.refresh_keys()
+
+        try:
+            return self.ring.keys.index(key)
+        except ValueError:
+            return -1
+
+    def skip(self, count):
+        """Remove the first ``count`` records from the batch"""
+        record_size = self.ring.record_size
+        chunks = []
+
+        for chunk in self.chunks:
+            n = min(count, len(chunk) // record_size)
+            count -= n
+
+            if n * record_size < len(chunk):
+                chunks.append(chunk[n * record_size :])
+
+        self.chunks = chunks
+
+    def release(self):
+        for chunk in self.chunks:
+            chunk.release()
+
 
 def _worker(
-    buffer: ShareableList,
+    segment_cls,
+    shm_name,
     observer_cls,
     observer_args,
     in_lock,
     out_lock,
     on_lock,
+    doorbell,
+    waiter: AdaptiveWait,
+    overwrite=False,
     index=0,
 ):
-    size = buffer[SHM_SIZE]  # len(buffer) == 84 but size == 20
+    shm = segment_cls(shm_name)
+    ring = RingLayout.attach(shm.buf)
+    buffer = ring.header
+    size = ring.size
+
+    # single producer/single consumer mode, header words are only written by one side
+    in_lock = in_lock or nullcontext()
+    out_lock = out_lock or nullcontext()
+    on_lock = on_lock or nullcontext()
+
+    def sleep(timeout):
+        # Ask the producer to ring the doorbell,
+        # check the index again so a push done in between is not missed.
+        # Both sides store then load without a fence, x86 can reorder them and a wakeup
+        # can still be missed: the timeout bounds the delay, it must be finite
+        buffer[SHM_SLEEPING] = 1
+
+        if buffer[SHM_INDEX_OUT] == buffer[SHM_INDEX_IN] and buffer[SHM_ON]:
+            doorbell.acquire(timeout=timeout)
+
+        buffer[SHM_SLEEPING] = 0
+
+    # id of the next object, a gap in the ids means objects were overwritten
+    next_id = 0
+
+    def count_overwritten(batch):
+        nonlocal next_id
+
+        ids = [record_id for _, record_id, _ in batch.frames()]
+        if ids:
+            buffer[SHM_OVERWRITTEN] += ids[0] - next_id
+            next_id = ids[-1] + 1
+
+    def deliver(batch):
+        if on_batch is not None:
+            try:
+                on_batch(batch)
+            except Exception:
+                traceback.print_exc()
+            return
+
+        for _, key, value in batch:
+            try:
+                observer(key, value)
+            except Exception:
+                traceback.print_exc()
+
+    def deliver_batch(counter, index_in):
+        batch = RecordBatch(ring, ring.chunks(counter, index_in))
+
+        if overwrite:
+            # copy the records before the producer writes over them, then discard
+            # the ones it might have started to overwrite during the copy, up to the end it announced
+            copies = [memoryview(bytes(chunk)) for chunk in batch.chunks]
+            batch.release()
+            batch = RecordBatch(ring, copies)
+
+            lapped = buffer[SHM_WRITE_END] - size - counter
+            if lapped > 0:
+                batch.skip(lapped)
+
+            count_overwritten(batch)
+
+        try:
+            deliver(batch)
+        finally:
+            batch.release()
 
     def event_loop():
         with on_lock:
@@ -45,24 +793,24 @@ def _worker(
         with in_lock:
             index_in = buffer[SHM_INDEX_IN]
 
-        while buffer[SHM_INDEX_OUT] < index_in:
-            # read only, no need for lock
-            counter = buffer[SHM_INDEX_OUT]
+        # read only, no need for lock
+        counter = buffer[SHM_INDEX_OUT]
 
-            idx = (counter % size) * 2
-            key = buffer[idx]
-            value = buffer[idx + 1]
+        if counter == index_in:
+            waiter.idle(sleep)
+            return True
 
-            try:
-                observer(key, value)
-            except Exception:
-                traceback.print_exc()
+        waiter.reset()
+
+        if overwrite and index_in - counter > size:
+            # the producer lapped the worker, the oldest records are gone,
+            # the lost objects are counted from the gap in the record ids
+            counter = index_in - size
 
-            # finished reading
-            # make sure we do an atomic write
-            with out_lock:
-                buffer[SHM_INDEX_OUT] = counter + 1
+        deliver_batch(counter, index_in)
 
+        with out_lock:
+            buffer[SHM_INDEX_OUT] = index_in
         return True
 
     # worker turned on
@@ -71,6 +819,8 @@ def _worker(
 
     try:
         observer = observer_cls(*observer_args)
+        observer.counters = lambda: read_counters(buffer)
+        on_batch = getattr(observer, "on_batch", None)
 
         with observer:
             while True:
@@ -84,145 +834,475 @@ def _worker(
         with on_lock:
             buffer[SHM_ON] = 0
 
+        buffer[SHM_CPU_TIME] = time.process_time_ns()
+        ring.release()
+        shm.close()
 
-def _preallocate_buffer(size, key_size=256):
-    template = []
-    for i in range(size * 2):
-        template.append(" " * 256)  # Key
-        template.append(int(0))  # Value
 
-    template.append(size)  # SHM_SIZE    -4
-    template.append(0)  # SHM_ON         -3
-    template.append(0)  # SHM_INDEX_OUT  -2
-    template.append(0)  # SHM_INDEX_IN   -1
+class Reservation:
+    """Slots reserved in the ring, they become visible to the worker once committed.
+    An object takes one slot per field plus one for its header.
 
-    return template
+    .. code-block:: python
 
+       batch = counter.reserve(4 * k)
+       for step in range(k):
+           batch.push_object(name="batch", time=time.time_ns(), batch_size=1024)
+       counter.commit(batch)
 
-class NotInitialized(Exception):
-    pass
+    """
 
+    def __init__(self, counter, start, count, dropped=False):
+        self.counter = counter
+        self.start = start
+        self.index = start
+        self.end = start + count
+        self.dropped = dropped
 
-class Backpressure(Exception):
-    pass
+    def push(self, key, value):
+        self.push_object(**{key: value})
+
+    def push_object(self, **kwargs):
+        if self.dropped:
+            self.counter._drop(1)
+            return
+
+        if self.index + len(kwargs) + 1 > self.end:
+            raise Backpressure("Not enough reserved slots")
+
+        self.index = self.counter._write_object(self.index, kwargs)
+
+
+class SingleProducer:
+    """Stands in for the producer lock in spsc mode,
+    the first thread that pushes owns the ring and the other threads are refused
+    """
+
+    def __init__(self):
+        self.owner = None
+        self.lock = threading.Lock()
 
+    def __enter__(self):
+        ident = threading.get_ident()
+        if ident != self.owner:
+            self._claim(ident)
+
+    def __exit__(self, *args):
+        pass
+
+    def _claim(self, ident):
+        with self.lock:
+            if self.owner is None:
+                self.owner = ident
 
-class WorkerStopped(Exception):
-    pass
+        if ident != self.owner:
+            raise RuntimeError(
+                "Only one thread can push in spsc mode, use spsc=False to push from several threads"
+            )
 
 
 class PerfCounter:
-    def __init__(self, observer_cls, observer_args, size=20000, key_size=64):
-        self.smm = SharedMemoryManager()
-        self.ringbuffer = []
+    """Push events to an observer running in a separate process
+
+    The ring is named ``cantilever_<pid>_<n>`` so other local processes can find it
+    with :func:`discover` and inspect it with :class:`CounterView`.
+
+    Parameters
+    ----------
+    spsc: bool
+        Single producer/single consumer mode.
+        ``SHM_INDEX_IN`` is only written by the producer and ``SHM_INDEX_OUT``
+        only by the worker; both are aligned 64-bit words which cannot tear,
+        so no lock is taken. Records are written before ``SHM_INDEX_IN`` is
+        published and the worker reads ``SHM_INDEX_IN`` before the records,
+        this relies on the store/store and load/load ordering of x86-64,
+        other architectures fall back to the locked mode.
+        Only one thread may push in this mode, the first thread that pushes owns the ring
+        and the others get a ``RuntimeError``.
+        Without it the pushes of the producer threads are serialized by a lock.
+
+    waiter: AdaptiveWait
+        How the worker waits when the ring is empty,
+        in the blocking phase it sleeps until the producer rings the doorbell
+        or for ``waiter.timeout`` seconds, which must be finite.
+
+    max_keys: int
+        Number of distinct keys, objects with a key past the limit are dropped
+
+    value_size: int
+        Maximum size in bytes of str and bytes values, numbers always fit.
+        Objects with a longer value, or a value of another type (``None``, list, dict...)
+        are dropped, or raise with the ``raise`` policy
+
+    backpressure: str
+        What to do when the ring is full, see :data:`BACKPRESSURE_POLICIES`.
+        Dropped objects are counted by the producer, overwritten objects by the worker.
+        ``overwrite`` relies on the memory ordering of x86-64 and is refused elsewhere.
+
+    block_timeout: float
+        Maximum time the producer waits for some room with the ``block`` policy
+
+    directory: str
+        Back the ring with a memory mapped file in this directory instead of shared memory.
+        The file is removed on exit if every record was consumed;
+        after a crash the remaining records can be recovered with :func:`replay`.
+
+    """
+
+    def __init__(
+        self,
+        observer_cls,
+        observer_args,
+        size=20000,
+        key_size=64,
+        spsc=False,
+        max_keys=256,
+        value_size=VALUE_SIZE,
+        waiter=None,
+        backpressure="drop",
+        block_timeout=0.01,
+        directory=None,
+    ):
+        if not ORDERED_STORES:
+            if backpressure == "overwrite":
+                raise ValueError(
+                    f"overwrite is not supported on {platform.machine()}, use drop or block"
+                )
+
+            if spsc:
+                warnings.warn(
+                    f"spsc is not supported on {platform.machine()}, falling back to locks"
+                )
+                spsc = False
+
+        self.directory = directory
+        self.name = f"{SHM_PREFIX}{os.getpid()}_{next(_counter_ids)}"
+        self.path = None
+        self.shm = None
+        self.ring = None
+        self.ringbuffer = None
         self.worker = None
         self.key_size = key_size
+        self.max_keys = max_keys
+        self.value_size = value_size
         self.size = size
+        self.spsc = spsc
         self.observer_cls = observer_cls
         self.observer_args = observer_args
         self.out_lock = None
         self.in_lock = None
+        # producer threads of this process, they would write to the same slots
+        self.producer_lock = SingleProducer() if spsc else threading.Lock()
         self.on_lock = None
+        self.doorbell = None
+        self.waiter = waiter or AdaptiveWait()
+        self.consumer_cpu_time = None
+        self.backpressure = check_policy(backpressure)
+        self.block_timeout = block_timeout
+        self.high_water = 0
+
+        if self.waiter.timeout is None:
+            # a missed doorbell would leave the worker asleep, and wait() hanging
+            raise ValueError("The shm worker needs a waiter with a finite timeout")
+        self.final_counters = None
         self.worker = None
 
     def __enter__(self):
-        self.smm.start()
-        self.ringbuffer = self.smm.ShareableList(
-            _preallocate_buffer(self.size, self.key_size)
+        nbytes = RingLayout.nbytes(
+            self.size, self.key_size, self.max_keys, self.value_size
+        )
+
+        if self.directory is None:
+            self.shm = SharedMemory(self.name, create=True, size=nbytes)
+            _owned.add(self.name)
+        else:
+            self.path = os.path.join(self.directory, f"{self.name}.ring")
+            self.shm = FileSegment(self.path, nbytes, create=True)
+
+        self.ring = RingLayout.create(
+            self.shm.buf, self.size, self.key_size, self.max_keys, self.value_size
         )
-        self.out_lock = multiprocessing.Lock()
-        self.in_lock = multiprocessing.Lock()
+        self.ringbuffer = self.ring.header
+        self.out_lock = self._make_lock()
+        self.in_lock = self._make_lock()
+        self.doorbell = multiprocessing.Semaphore(0)
         self._init_worker()
         return self
 
+    def _make_lock(self):
+        if self.spsc:
+            return None
+        return multiprocessing.Lock()
+
     def _init_worker(self):
-        self.on_lock = multiprocessing.Lock()
+        self.on_lock = self._make_lock()
         self.worker = multiprocessing.Process(
             target=_worker,
             args=(
-                self.ringbuffer,
+                type(self.shm),
+                self.shm.name,
                 self.observer_cls,
                 self.observer_args,
                 self.in_lock,
                 self.out_lock,
                 self.on_lock,
+                self.doorbell,
+                self.waiter,
+                self.backpressure == "overwrite",
             ),
         )
         self.worker.start()
         self._wait_worker_init(self.on_lock)
 
-    def _wait_worker_init(self, on_lock):
-        while True:
-            with on_lock:
-                is_ready = self.ringbuffer[SHM_ON]
+    def _read(self, lock, index):
+        if lock is None:
+            return self.ringbuffer[index]
 
-            if is_ready:
-                break
+        with lock:
+            return self.ringbuffer[index]
 
-    def wait(self):
-        # Wait for worker to catch up
-        with self.in_lock:
-            in_pos = self.ringbuffer[SHM_INDEX_IN]
+    def _write(self, lock, index, value):
+        if lock is None:
+            self.ringbuffer[index] = value
+            return
 
-        while True:
-            with self.on_lock:
-                is_on = self.ringbuffer[SHM_ON]
+        with lock:
+            self.ringbuffer[index] = value
 
-            if not is_on:
-                break
+    def _producer_waiter(self):
+        # nobody rings a doorbell for the producer, it sleeps for a short while instead
+        return AdaptiveWait(self.waiter.spin, self.waiter.yields, timeout=0.001)
 
-            with self.out_lock:
-                out_pos = self.ringbuffer[SHM_INDEX_OUT]
+    def _wait_worker_init(self, on_lock):
+        self._producer_waiter().until(
+            lambda: self._read(on_lock, SHM_ON) or not self.worker.is_alive()
+        )
 
-            if out_pos == in_pos:
-                break
+    def wait(self):
+        # Wait for worker to catch up
+        in_pos = self._read(self.in_lock, SHM_INDEX_IN)
+
+        def caught_up():
+            is_on = self._read(self.on_lock, SHM_ON) and self.worker.is_alive()
+            # the worker consumes whole batches, it can go past what was pushed before the call
+            return not is_on or self._read(self.out_lock, SHM_INDEX_OUT) >= in_pos
+
+        self._producer_waiter().until(caught_up)
 
     def __exit__(self, *args):
         self.wait()
 
-        with self.on_lock:
-            self.ringbuffer[SHM_ON] = 0
+        self._write(self.on_lock, SHM_ON, 0)
+        self.doorbell.release()
 
         self.worker.join()
-        return self.smm.__exit__(*args)
+        self.consumer_cpu_time = self.ringbuffer[SHM_CPU_TIME] * 1e-9
+        self.final_counters = read_counters(self.ringbuffer)
+        consumed = self.ringbuffer[SHM_INDEX_OUT] == self.ringbuffer[SHM_INDEX_IN]
+
+        self.ring.release()
+        self.ring = None
+        self.ringbuffer = None
+        self.shm.close()
+
+        # keep the records the worker did not get to for replay
+        if self.directory is None or consumed:
+            self.shm.unlink()
+            _owned.discard(self.name)
+
+    def counters(self):
+        """Backpressure counters, dropped and overwritten are in number of objects"""
+        if self.ringbuffer is None:
+            return self.final_counters
 
-    def push_object(self, **kwargs):
-        with self.on_lock:
-            if self.ringbuffer[SHM_ON] == 0:
-                raise WorkerStopped()
+        return read_counters(self.ringbuffer)
 
-        in_index = self.ringbuffer[SHM_INDEX_IN]
+    def _out_index(self):
+        if self.spsc:
+            return self.ringbuffer[SHM_INDEX_OUT]
 
+        # worker could be writing to it
+        # get the out lock to make sure writing is finished
         with self.out_lock:
-            out_index = self.ringbuffer[SHM_INDEX_OUT]
+            return self.ringbuffer[SHM_INDEX_OUT]
+
+    def _check_space(self, in_index, count, objects=1):
+        """Returns true if ``count`` records can be written at ``in_index``,
+        false if the ``objects`` they hold have to be dropped
+        """
+        if self.spsc:
+            is_on = self.ringbuffer[SHM_ON]
+        else:
+            with self.on_lock:
+                is_on = self.ringbuffer[SHM_ON]
+
+        if is_on == 0:
+            raise WorkerStopped()
+
+        policy = self.backpressure
+
+        if count > self.size:
+            if policy == "raise":
+                raise Backpressure("Ring is too small for this many records")
+
+            self._drop(objects)
+            return False
+
+        depth = in_index + count - self._out_index()
 
-        queued_items = in_index - out_index
-        free_space = self.size - queued_items
+        if depth > self.high_water:
+            self.high_water = depth
+            self.ringbuffer[SHM_HIGH_WATER] = min(depth, self.size)
 
-        if free_space < (len(kwargs) + 2):
-            raise Backpressure("Not enough slots to push object")
+        if policy == "overwrite":
+            # the worker detects it was lapped and accounts for the lost objects,
+            # announce the slots about to be written so it discards them from its copy
+            self.ringbuffer[SHM_WRITE_END] = in_index + count
+            return True
 
-        for k, v in kwargs.items():
-            idx = (in_index % self.size) * 2
-            self.ringbuffer[idx] = k
-            self.ringbuffer[idx + 1] = v
-            in_index += 1
+        if depth <= self.size:
+            if policy == "sample" and not keep_sample(depth, self.size):
+                self._drop(objects)
+                return False
+
+            return True
+
+        if policy == "raise":
+            raise Backpressure("Worker is not able to process all those events")
+
+        if policy == "block" and self._block(in_index, count):
+            return True
 
-        # worker might be reading while we write
-        with self.in_lock:
+        self._drop(objects)
+        return False
+
+    def _block(self, in_index, count):
+        deadline = time.monotonic() + self.block_timeout
+
+        def has_space():
+            return in_index + count - self._out_index() <= self.size
+
+        self._producer_waiter().until(
+            lambda: has_space() or time.monotonic() > deadline
+        )
+        return has_space()
+
+    def _drop(self, count):
+        # only the producer writes this counter
+        self.ringbuffer[SHM_DROPPED] += count
+
+    def _refuse(self, error):
+        # an object that cannot be written is dropped, unless raising was asked for
+        if self.backpressure == "raise":
+            raise error
+
+        self._drop(1)
+
+    def _write_object(self, in_index, obj):
+        """Write ``obj`` at ``in_index``, returns the index following it,
+        ``in_index`` if it was dropped because one of its fields cannot be stored
+        """
+        try:
+            return self.ring.write_object(in_index, obj)
+        except WRITE_ERRORS as error:
+            self._refuse(error)
+            return in_index
+
+    def _publish(self, in_index):
+        # "SHM_INDEX_IN" is read by the worker
+        # in lock mode it needs to be locked to avoid partial reads
+        if self.spsc:
             self.ringbuffer[SHM_INDEX_IN] = in_index
+        else:
+            with self.in_lock:
+                self.ringbuffer[SHM_INDEX_IN] = in_index
+
+        # the worker is blocked waiting for work, wake it up
+        if self.ringbuffer[SHM_SLEEPING]:
+            self.doorbell.release()
+
+    def push_object(self, **kwargs):
+        if self.ringbuffer is None:
+            raise NotInitialized("Shared memory is not initialized")
+
+        with self.producer_lock:
+            in_index = self.ringbuffer[SHM_INDEX_IN]
+            if not self._check_space(in_index, len(kwargs) + 1):
+                return
+
+            end = self._write_object(in_index, kwargs)
+
+            # worker might be reading while we write
+            if end != in_index:
+                self._publish(end)
+
+    def push_many(self, objects):
+        """Push a sequence of objects, they are published with a single index update.
+        When they do not fit in the ring at once they are published in several chunks
+        """
+        chunk = []
+        count = 0
+
+        for obj in objects:
+            n = len(obj) + 1
+
+            if chunk and count + n > self.size:
+                self._push_chunk(chunk, count)
+                chunk = []
+                count = 0
+
+            chunk.append(obj)
+            count += n
+
+        if chunk:
+            self._push_chunk(chunk, count)
+
+    def _push_chunk(self, objects, count):
+        with self.producer_lock:
+            reservation = self._reserve(count, len(objects))
+            if reservation.dropped:
+                return
+
+            write_object = self._write_object
+            in_index = reservation.start
+            try:
+                for obj in objects:
+                    in_index = write_object(in_index, obj)
+            finally:
+                # with the raise policy, publish the objects written before the refused one
+                reservation.index = in_index
+                self.commit(reservation)
+
+    def reserve(self, count):
+        """Reserve ``count`` slots, nothing is visible to the worker until :meth:`commit`.
+        Only one reservation can be in flight at a time, and no other push until it is committed.
+        """
+        # the objects pushed to a dropped reservation are counted as they are pushed
+        return self._reserve(count, 0)
+
+    def _reserve(self, count, objects):
+        if self.ringbuffer is None:
+            raise NotInitialized("Shared memory is not initialized")
+
+        in_index = self.ringbuffer[SHM_INDEX_IN]
+        if not self._check_space(in_index, count, objects):
+            return Reservation(self, in_index, 0, dropped=True)
+
+        return Reservation(self, in_index, count)
+
+    def commit(self, reservation):
+        """Publish the records written in the reservation"""
+        if not reservation.dropped:
+            self._publish(reservation.index)
 
     def _push_unsafe(self, key, value, counter):
         # no need to lock, we are the only one writing to it
-        idx = (counter % self.size) * 2
-        self.ringbuffer[idx] = key
-        self.ringbuffer[idx + 1] = value
+        # a single field object, its record then its header
+        self.ring.write(counter + 1, key, value)
+        self.ring.write_header(counter, 1)
 
         # finished writing
-        # "SHM_INDEX_IN" is read by the worker
-        # and need to be locked to avoid partial reads
-        with self.in_lock:
-            self.ringbuffer[SHM_INDEX_IN] = counter + 1
+        self._publish(counter + 2)
 
     def push_unsafe(self, key, value):
         self._push_unsafe(key, value, self.ringbuffer[SHM_INDEX_IN])
@@ -231,38 +1311,33 @@ class PerfCounter:
         if self.ringbuffer is None:
             raise NotInitialized("Shared memory is not initialized")
 
-        with self.on_lock:
-            if self.ringbuffer[SHM_ON] == 0:
-                raise WorkerStopped()
-
-        in_index = self.ringbuffer[SHM_INDEX_IN]
+        with self.producer_lock:
+            in_index = self.ringbuffer[SHM_INDEX_IN]
+            if not self._check_space(in_index, 2):
+                return
 
-        # worker could be writing to it
-        # get the out lock to make sure writing is finished
-        with self.out_lock:
-            out_index = self.ringbuffer[SHM_INDEX_OUT]
+            try:
+                self._push_unsafe(key, value, in_index)
+            except WRITE_ERRORS as error:
+                self._refuse(error)
 
-        if out_index + self.size + 1 <= in_index:
-            raise Backpressure("Worker is not able to process all those events")
 
-        if len(key) > self.key_size:
-            raise ValueError("Key is bigger than storage")
+class ObjectAssembler(Observer):
+    """Assemble the framed records back into objects and give them to :meth:`push`
 
-        self._push_unsafe(key, value, in_index)
+    Parameters
+    ----------
+    select:
+        ``select(key, value)`` receives the first field of each object,
+        the objects it rejects are skipped without decoding their other fields
 
+    """
 
-my_perf_counter = time.perf_counter_ns
+    select = None
 
-
-class ObjectAssembler(Observer):
-    def __init__(self) -> None:
-        self.fp = None
-        self.acc = {}
-        self.time_diff = 0
-        self.count = 0
-        self.start_time = None
-        self.end_time = None
-        self.object_building = False
+    def __init__(self, select=None) -> None:
+        if select is not None:
+            self.select = select
 
     def __enter__(self):
         return self
@@ -273,60 +1348,52 @@ class ObjectAssembler(Observer):
     def push(self, object):
         pass
 
+    def on_batch(self, batch):
+        push = self.push
+        for obj in batch.objects(self.select):
+            push(obj)
+
     def __call__(self, key, value):
-        if key == "name":
-            if self.acc:
-                self.push(self.acc)
-                self.object_building = False
-
-            self.acc = {key: value}
-            self.start_time = value
-            self.object_building = True
-            return
+        # records given one at a time are not framed
+        self.push({key: value})
 
-        if self.object_building:
-            self.acc[key] = value
-        else:
-            self.push({key: value})
 
+class Assembled(ObjectAssembler):
+    """Assemble the records back into objects and forward them to an observer
+    following the shared protocol, see :class:`cantilever.core.perfcounter.Observer`.
+    A ``select`` method of the observer is used to skip objects, see :class:`ObjectAssembler`.
+    """
 
-class Source(ObjectAssembler):
-    def __init__(self, handler) -> None:
-        super().__init__()
-        self.reactivex_observer = None
-        self.reactivex_scheduler = None
-        self.source = None
-        self.handler = handler
-        self.pending = []
+    def __init__(self, observer_cls, *observer_args) -> None:
+        self.observer = observer_cls(*observer_args)
+        super().__init__(getattr(self.observer, "select", None))
 
     def __enter__(self):
-        def make(observer, scheduler):
-            self.reactivex_observer = observer
-            self.reactivex_scheduler = scheduler
-
-        import reactivex as rx
-
-        self.source = rx.create(make)
-        self.handler(
-            self.source,
-            lambda: self.reactivex_observer,
-            lambda: self.reactivex_scheduler,
-        )
+        self.observer.counters = self.counters
+        self.observer.__enter__()
         return self
 
     def __exit__(self, *args):
-        if self.reactivex_observer:
-            self.reactivex_observer.on_completed()
-        else:
-            raise RuntimeError("reactivex_observer was never set")
-        return
+        return self.observer.__exit__(*args)
 
     def push(self, object):
-        if self.reactivex_observer:
-            if self.pending:
-                for obj in self.pending:
-                    self.reactivex_observer.on_next(obj)
+        self.observer(object)
 
-            self.reactivex_observer.on_next(object)
-        else:
-            self.pending.append(object)
+    def on_batch(self, batch):
+        on_batch = getattr(self.observer, "on_batch", None)
+        if on_batch is None:
+            return super().on_batch(batch)
+
+        objects = list(batch.objects(self.select))
+        if objects:
+            on_batch(objects)
+
+
+class Source(Assembled):
+    def __init__(self, handler, *args) -> None:
+        super().__init__(ObjectSource, handler, *args)
+
+
+class RxSource(Assembled):
+    def __init__(self, handler, *args) -> None:
+        super().__init__(ObjectRxSource, handler, *args)
@@ -1,53 +1,245 @@
+import heapq
+import threading
 import time
-import queue
 import traceback
-import threading
-import queue
+from collections import deque
+
+from .backoff import AdaptiveWait, check_policy, keep_sample
+
+# Observer, ObjectAssembler, Source and the exceptions are shared by all the backends
+from .perfcounter import (
+    STATE_CPU_TIME,
+    STATE_HIGH_WATER,
+    STATE_ON,
+    Backpressure,
+    MessageBatching,
+    NotInitialized,
+    ObjectAssembler,
+    Observer,
+    Reservation,
+    RxSource,
+    Source,
+    WorkerStopped,
+    _count,
+    _dispatch,
+    _dispatch_batch,
+    my_perf_counter,
+)
+
+# Maximum number of messages drained from a single producer in one round
+MAX_BATCH = 4096
+
+
+def read_counters(state, buffers):
+    dropped = buffers.retired.dropped
+    overwritten = buffers.retired.overwritten
+    for producer in buffers.producers:
+        dropped += producer.dropped
+        overwritten += producer.overwritten
+
+    return dict(
+        dropped=dropped,
+        overwritten=overwritten,
+        high_water=state[STATE_HIGH_WATER],
+    )
+
+
+class ProducerBuffer:
+    """Messages pushed by a single thread.
+
+    Only the owning thread appends and only the worker pops, ``deque.append`` and ``deque.popleft``
+    are atomic so no lock is needed. Each counter is written by a single thread.
+    """
+
+    __slots__ = ("messages", "thread", "pushed", "taken", "dropped", "overwritten")
+
+    def __init__(self, thread):
+        self.messages = deque()
+        self.thread = thread
+        self.pushed = 0  # producer
+        self.taken = 0  # worker
+        self.dropped = 0  # producer
+        self.overwritten = 0  # producer
+
+
+class Buffers:
+    """The producer buffers and the doorbell shared with the worker"""
+
+    def __init__(self):
+        self.local = threading.local()
+        # copy on write, the worker iterates over it without taking the lock
+        self.producers = ()
+        # counters of the threads that are gone
+        self.retired = ProducerBuffer(None)
+        self.lock = threading.Lock()
+        self.doorbell = threading.Event()
+        self.delivered = threading.Condition()
+        self.sleeping = False
+        self.closing = False
+
+    def get(self):
+        """Buffer of the calling thread, the lock is only taken the first time"""
+        try:
+            return self.local.buffer
+        except AttributeError:
+            pass
+
+        buffer = ProducerBuffer(threading.current_thread())
+        with self.lock:
+            self.producers = self.producers + (buffer,)
+
+        self.local.buffer = buffer
+        return buffer
+
+    def ring(self):
+        if self.sleeping:
+            self.doorbell.set()
+
+    def empty(self):
+        for producer in self.producers:
+            if producer.messages:
+                return False
+        return True
 
-SHM_INDEX_IN = -1
-SHM_INDEX_OUT = -2
-SHM_ON = -3
-SHM_SIZE = -4
-SHM_MAX = 4
+    def pending(self):
+        for producer in self.producers:
+            if producer.pushed != producer.taken:
+                return True
+        return False
 
+    def prune(self):
+        # forget the threads that are gone once everything they pushed was delivered
+        with self.lock:
+            alive = []
+            for producer in self.producers:
+                if producer.thread.is_alive() or producer.pushed != producer.taken:
+                    alive.append(producer)
+                else:
+                    self.retired.dropped += producer.dropped
+                    self.retired.overwritten += producer.overwritten
 
-class Observer:
-    def __init__(self) -> None:
-        pass
+            self.producers = tuple(alive)
 
-    def __call__(self, key, value):
-        pass
+    def notify(self):
+        with self.delivered:
+            self.delivered.notify_all()
 
-    def __enter__(self):
-        return self
 
-    def __exit__(self, *args):
-        pass
+def _discard(buffers):
+    # the worker is gone, release ``wait()`` and count what is left as dropped
+    for producer in buffers.producers:
+        messages = producer.messages
 
+        while messages:
+            producer.dropped += _count(messages.popleft())
+            producer.taken += 1
 
-def _worker(buffer: queue.Queue, observer_cls, observer_args, state):
-    def event_loop():
-        if state[SHM_ON] == 0:
-            return False
+    buffers.notify()
 
-        while True:
-            try:
-                msg = buffer.get_nowait()
 
-                observer(msg)
-            except queue.Empty:
+def _worker(buffers: Buffers, observer_cls, observer_args, state, waiter, merge):
+    def sleep(timeout):
+        # the producers ring the doorbell when they see the worker sleeping
+        buffers.sleeping = True
+        try:
+            if not buffers.empty() or buffers.closing:
                 return True
 
-            except Exception:
-                traceback.print_exc()
+            return buffers.doorbell.wait(timeout)
+        finally:
+            buffers.sleeping = False
+            buffers.doorbell.clear()
+
+    def deliver(messages):
+        if on_batch is not None:
+            _dispatch_batch(observer, messages)
+            return
+
+        for msg in messages:
+            _dispatch(observer, msg)
+
+    high_water = 0
+
+    def track_high_water(depth):
+        nonlocal high_water
+
+        if depth > high_water:
+            high_water = depth
+            state[STATE_HIGH_WATER] = depth
+
+    def drain():
+        # one round, take what is available from every producer
+        chunks = []
+        taken = []
+        depth = 0
+
+        for producer in buffers.producers:
+            available = len(producer.messages)
+            if available == 0:
+                continue
+
+            depth = max(depth, available)
+            popleft = producer.messages.popleft
+            chunk = []
+            try:
+                for _ in range(min(available, MAX_BATCH)):
+                    chunk.append(popleft())
+            except IndexError:
+                # the producer overwrote some of them in the meantime
+                pass
+
+            chunks.append(chunk)
+            taken.append(producer)
+
+        if not chunks:
+            return None, taken
+
+        track_high_water(depth)
+
+        if merge:
+            # each chunk is ordered, merge them by timestamp
+            messages = [msg for _, msg in heapq.merge(*chunks, key=_timestamp)]
+        else:
+            messages = [msg for chunk in chunks for msg in chunk]
+
+        return (messages, [len(c) for c in chunks]), taken
+
+    def event_loop():
+        # read before draining, everything pushed before the exit is delivered
+        closing = buffers.closing
+
+        batch, taken = drain()
+
+        if batch is not None:
+            messages, counts = batch
+
+            waiter.reset()
+            deliver(messages)
 
+            for producer, count in zip(taken, counts):
+                producer.taken += count
+
+            buffers.notify()
+            return True
+
+        if closing:
+            return False
+
+        for producer in buffers.producers:
+            if not producer.thread.is_alive():
+                buffers.prune()
+                break
+
+        waiter.idle(sleep)
         return True
 
     # worker turned on
-    state[SHM_ON] = 1
+    state[STATE_ON] = 1
 
     try:
         observer = observer_cls(*observer_args)
+        observer.counters = lambda: read_counters(state, buffers)
+        on_batch = getattr(observer, "on_batch", None)
 
         with observer:
             while True:
@@ -58,121 +250,160 @@ def _worker(buffer: queue.Queue, observer_cls, observer_args, state):
         traceback.print_exc()
 
     finally:
-        state[SHM_ON] = 0
+        state[STATE_ON] = 0
+        state[STATE_CPU_TIME] = time.thread_time()
+        _discard(buffers)
+
 
+def _timestamp(item):
+    return item[0]
 
-class NotInitialized(Exception):
-    pass
 
+class PerfCounter(MessageBatching):
+    """Send events to an observer running in a separate thread
 
-class Backpressure(Exception):
-    pass
+    Each producer thread pushes to its own buffer, the worker drains all the buffers in rounds.
+    The events of a thread are delivered in order, events of different threads are interleaved
+    round by round unless ``merge`` is set.
 
+    Parameters
+    ----------
+    size: int
+        Maximum number of messages waiting in the buffer of a single thread
 
-class WorkerStopped(Exception):
-    pass
+    merge: bool
+        Timestamp the events when pushed, the events drained in a round are then
+        delivered in timestamp order across threads
 
+    """
 
-class PerfCounter:
-    def __init__(self, observer_cls, observer_args, size=30):
-        self.queue = queue.Queue(size)
-        self.state = dict()             # <= this guy is relying on GIL
+    def __init__(
+        self,
+        observer_cls,
+        observer_args,
+        size=30,
+        waiter=None,
+        backpressure="drop",
+        block_timeout=0.01,
+        merge=False,
+    ):
+        self.buffers = Buffers()
+        self.state = dict()  # <= this guy is relying on GIL
         self.worker = None
         self.size = size
         self.observer_cls = observer_cls
         self.observer_args = observer_args
-        self.worker = None
+        # block until something is pushed, no polling
+        self.waiter = waiter or AdaptiveWait(spin=0, yields=0, timeout=None)
+        self.consumer_cpu_time = None
+        self.backpressure = check_policy(backpressure)
+        self.block_timeout = block_timeout
+        self.merge = merge
+        self.final_counters = None
 
     def __enter__(self):
         self._init_worker()
         return self
 
     def _init_worker(self):
-        self.state[SHM_ON] = 0
+        self.state[STATE_ON] = 0
+        self.state[STATE_HIGH_WATER] = 0
         self.worker = threading.Thread(
             target=_worker,
-            args=(self.queue, self.observer_cls, self.observer_args, self.state),
+            args=(
+                self.buffers,
+                self.observer_cls,
+                self.observer_args,
+                self.state,
+                self.waiter,
+                self.merge,
+            ),
         )
         self.worker.start()
         self._wait_worker_init()
 
     def _wait_worker_init(self):
-        while not self.state[SHM_ON]:
+        while not self.state[STATE_ON]:
             time.sleep(0.1)
 
+    def _delivered(self):
+        return not self.buffers.pending() or self.state[STATE_ON] == 0
+
     def wait(self):
-        while not self.queue.empty():
-            time.sleep(0.1)
+        """Wait until everything pushed so far was delivered"""
+        self.buffers.ring()
+
+        with self.buffers.delivered:
+            self.buffers.delivered.wait_for(self._delivered)
 
     def __exit__(self, *args):
-        self.wait()
-        self.state[SHM_ON] = 0
+        self.buffers.closing = True
+        self.buffers.doorbell.set()
+
         self.worker.join()
+        self.consumer_cpu_time = self.state[STATE_CPU_TIME]
+        self.final_counters = read_counters(self.state, self.buffers)
 
     def push_object(self, **kwargs):
-        if self.state[SHM_ON] == 0:
+        if self.state[STATE_ON] == 0:
             raise WorkerStopped()
 
-        self.queue.put_nowait(kwargs)
+        self._put(kwargs)
 
+    def counters(self):
+        """Backpressure counters, dropped and overwritten are in number of objects"""
+        if self.final_counters is not None:
+            return self.final_counters
 
-my_perf_counter = time.perf_counter_ns
+        return read_counters(self.state, self.buffers)
 
+    def _put(self, msg):
+        buffer = self.buffers.get()
+        messages = buffer.messages
+        policy = self.backpressure
+        depth = len(messages)
 
-class ObjectAssembler(Observer):
-    def __init__(self) -> None:
-        pass
+        if policy == "sample" and not keep_sample(depth, self.size):
+            buffer.dropped += _count(msg)
+            return
 
-    def __enter__(self):
-        return self
+        if depth >= self.size:
+            if policy == "raise":
+                raise Backpressure()
 
-    def __exit__(self, *args):
-        return
+            if policy == "overwrite":
+                self._overwrite(buffer)
 
-    def push(self, object):
-        pass
+            elif policy != "block" or not self._block(buffer):
+                buffer.dropped += _count(msg)
+                return
 
-    def __call__(self, obj):
-        self.push(obj)
+        if self.merge:
+            msg = (my_perf_counter(), msg)
 
+        messages.append(msg)
+        buffer.pushed += 1
+        self.buffers.ring()
 
-class Source(ObjectAssembler):
-    def __init__(self, handler) -> None:
-        super().__init__()
-        self.reactivex_observer = None
-        self.reactivex_scheduler = None
-        self.source = None
-        self.handler = handler
-        self.pending = []
+    def _block(self, buffer):
+        # wait for the worker to make some room
+        self.buffers.ring()
 
-    def __enter__(self):
-        def make(observer, scheduler):
-            self.reactivex_observer = observer
-            self.reactivex_scheduler = scheduler
+        with self.buffers.delivered:
+            return self.buffers.delivered.wait_for(
+                lambda: len(buffer.messages) < self.size or self.state[STATE_ON] == 0,
+                timeout=self.block_timeout,
+            )
 
-        import reactivex as rx
+    def _overwrite(self, buffer):
+        try:
+            oldest = buffer.messages.popleft()
+        except IndexError:
+            # the worker took it
+            return
 
-        self.source = rx.create(make)
-        self.handler(
-            self.source,
-            lambda: self.reactivex_observer,
-            lambda: self.reactivex_scheduler,
-        )
-        return self
-
-    def __exit__(self, *args):
-        if self.reactivex_observer:
-            self.reactivex_observer.on_completed()
-        else:
-            raise RuntimeError("reactivex_observer was never set")
-        return
-
-    def push(self, object):
-        if self.reactivex_observer:
-            if self.pending:
-                for obj in self.pending:
-                    self.reactivex_observer.on_next(obj)
+        if self.merge:
+            oldest = oldest[1]
 
-            self.reactivex_observer.on_next(object)
-        else:
-            self.pending.append(object)
+        buffer.overwritten += _count(oldest)
+        buffer.pushed -= 1
@@ -1,26 +1,35 @@
-import torch
 import array
 
+try:
+    import torch
+except ImportError:
+    torch = None
+
 
 class RingBuffer:
-    types = {
-        torch.float16: 'f',  # 4
-        torch.float32: 'f',  # 4
-        torch.float64: 'd',  # 8
-
-        torch.int8:  'b',    # 1
-        torch.int16: 'h',    # 2
-        torch.int32: 'l',    # 4
-        torch.int64: 'q',    # 8
-
-        torch.uint8:  'B',   # 1
-        # torch.uint16: 'H',   # 2
-        # torch.uint32: 'L',   # 4
-        # torch.uint64: 'Q',   # 8
-    }
+    """Fixed size buffer, ``dtype`` is a torch dtype or an :mod:`array` typecode"""
+
+    types = {}
+
+    if torch is not None:
+        types = {
+            torch.float16: 'f',  # 4
+            torch.float32: 'f',  # 4
+            torch.float64: 'd',  # 8
+
+            torch.int8:  'b',    # 1
+            torch.int16: 'h',    # 2
+            torch.int32: 'l',    # 4
+            torch.int64: 'q',    # 8
+
+            torch.uint8:  'B',   # 1
+            # torch.uint16: 'H',   # 2
+            # torch.uint32: 'L',   # 4
+            # torch.uint64: 'Q',   # 8
+        }
 
     def __init__(self, size, dtype, default_val=0):
-        self.array = array.array(self.types[dtype], [default_val] * size)
+        self.array = array.array(self.types.get(dtype, dtype), [default_val] * size)
         self.capacity = size
         self.offset = 0
 
@@ -66,4 +75,4 @@ class RingBuffer:
 
 if __name__ == '__main__':
 
-    print(RingBuffer.from_list([1, 2, 3], 10, torch.float32))
+    print(RingBuffer.from_list([1, 2, 3], 10, 'f'))
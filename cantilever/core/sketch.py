@@ -0,0 +1,146 @@
+import math
+import struct
+import sys
+from array import array
+from multiprocessing.sharedctypes import RawArray
+
+PERCENTILES = (50, 95, 99)
+
+# alpha, min_value, max_value, first bucket and number of buckets saved
+SNAPSHOT = struct.Struct("<dddqq")
+
+
+class QuantileSketch:
+    """Fixed memory quantile sketch, the observations are counted in log-spaced buckets (DDSketch)
+
+    A quantile is estimated within ``alpha`` relative error for values in ``[min_value, max_value]``,
+    smaller values (zero and negative included) are counted in the first bucket
+    and larger values in the last one.
+    Adding a value is constant time, merging two sketches is linear in the number of buckets.
+
+    Parameters
+    ----------
+    alpha: float
+        Relative accuracy, the number of buckets grows with ``log(max_value / min_value) / alpha``
+
+    shared: bool
+        Store the buckets in shared memory, the owner of the sketch is responsible for locking
+
+    """
+
+    __slots__ = ("alpha", "min_value", "max_value", "log_gamma", "offset", "counts")
+
+    def __init__(self, alpha=0.01, min_value=1e-9, max_value=1e6, shared=False):
+        self.alpha = alpha
+        self.min_value = min_value
+        self.max_value = max_value
+        self.log_gamma = math.log((1 + alpha) / (1 - alpha))
+        self.offset = self._key(min_value)
+
+        size = self._key(max_value) - self.offset + 1
+        if shared:
+            self.counts = RawArray("q", size)
+        else:
+            self.counts = array("q", bytes(8 * size))
+
+    def _key(self, value):
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def index(self, value):
+        """Bucket of ``value``"""
+        if value <= self.min_value:
+            return 0
+
+        if value >= self.max_value:
+            return len(self.counts) - 1
+
+        return math.ceil(math.log(value) / self.log_gamma) - self.offset
+
+    def value(self, index):
+        """Value representing the bucket ``index``, within ``alpha`` of any value of the bucket"""
+        gamma = math.exp(self.log_gamma)
+        return 2 * gamma ** (index + self.offset) / (gamma + 1)
+
+    def add(self, value, weight=1):
+        self.counts[self.index(value)] += weight
+
+    def add_many(self, values, weights=None):
+        """Add an array of values in one pass, requires NumPy"""
+        import numpy as np
+
+        values = np.clip(
+            np.asarray(values, dtype=np.float64), self.min_value, self.max_value
+        )
+        index = np.ceil(np.log(values) / self.log_gamma).astype(np.int64) - self.offset
+        np.clip(index, 0, len(self.counts) - 1, out=index)
+
+        added = np.bincount(index, weights=weights, minlength=len(self.counts))
+        counts = np.frombuffer(self.counts, dtype=np.int64)
+        counts += added.astype(np.int64)
+
+    def merge(self, other):
+        """Add the counts of ``other``, both sketches must use the same buckets"""
+        if (self.alpha, self.min_value, self.max_value) != (
+            other.alpha,
+            other.min_value,
+            other.max_value,
+        ):
+            raise ValueError("Sketches do not use the same buckets")
+
+        counts = self.counts
+        for i, c in enumerate(other.counts):
+            if c:
+                counts[i] += c
+
+    def snapshot(self):
+        """Parameters and counts as bytes, only the range of non empty buckets is saved"""
+        counts = array("q", bytes(self.counts))
+        if sys.byteorder == "big":
+            counts.byteswap()
+
+        raw = counts.tobytes()
+        first = (len(raw) - len(raw.lstrip(b"\0"))) // 8
+        last = -(-len(raw.rstrip(b"\0")) // 8)
+        size = max(last - first, 0)
+
+        header = SNAPSHOT.pack(self.alpha, self.min_value, self.max_value, first, size)
+        return header + raw[first * 8 : (first + size) * 8]
+
+    @classmethod
+    def from_snapshot(cls, buf, offset=0, shared=False):
+        """Sketch saved at ``offset`` in ``buf``, returns the sketch and the offset following it"""
+        alpha, min_value, max_value, first, size = SNAPSHOT.unpack_from(buf, offset)
+        offset += SNAPSHOT.size
+
+        self = cls(alpha, min_value, max_value, shared=shared)
+
+        counts = array("q", bytes(buf[offset : offset + size * 8]))
+        if sys.byteorder == "big":
+            counts.byteswap()
+
+        self.counts[first : first + size] = counts
+        return self, offset + size * 8
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        """Estimate of the ``q`` quantile, ``q`` in ``[0, 1]``; NaN without observations"""
+        count = self.count
+        if count == 0:
+            return float("nan")
+
+        rank = q * (count - 1)
+
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen > rank:
+                return self.value(i)
+
+        return self.value(len(self.counts) - 1)
+
+    def percentiles(self, percentiles=PERCENTILES):
+        """``{p50: ..., p95: ..., p99: ...}``"""
+        return {f"p{p:g}": self.quantile(p / 100) for p in percentiles}
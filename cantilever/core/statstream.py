@@ -1,70 +1,221 @@
+import itertools
 import json
 import math
+import struct
+import sys
+from array import array
+from contextlib import nullcontext
 from ctypes import Structure, c_double, c_int
 from multiprocessing.sharedctypes import Value
 
+from .ring import RingBuffer
+from .sketch import PERCENTILES, QuantileSketch
+
+SNAPSHOT_VERSION = 1
+
+# version, kind, has sketch, then the StatStreamStruct fields
+SNAPSHOT = struct.Struct("<BBB5xddddqqdq")
+
+# length prefix of the names and snapshots of a tree of streams
+LENGTH = struct.Struct("<I")
+
 
 class StatStreamStruct(Structure):
     _fields_ = [
-        ("sum", c_double),
-        ("sum_sqr", c_double),
-        ("first_obs", c_double),
+        ("mean", c_double),
+        ("m2", c_double),
         ("min", c_double),
         ("max", c_double),
+        ("count", c_int),
         ("current_count", c_int),
         ("current_obs", c_double),
         ("drop_obs", c_int),
     ]
 
 
+class StatStreamState:
+    """Same fields as :class:`StatStreamStruct` stored in a plain python object, for in-process use"""
+
+    __slots__ = [name for name, _ in StatStreamStruct._fields_]
+
+    def __init__(self, mean, m2, min, max, count, current_count, current_obs, drop_obs):
+        self.mean = mean
+        self.m2 = m2
+        self.min = min
+        self.max = max
+        self.count = count
+        self.current_count = current_count
+        self.current_obs = current_obs
+        self.drop_obs = drop_obs
+
+
+def _update(struct, val, weight):
+    struct.current_count += weight
+    struct.current_obs = val
+
+    if struct.current_count <= struct.drop_obs:
+        return
+
+    # Welford, weighted
+    count = struct.count + weight
+    delta = val - struct.mean
+    struct.mean += delta * weight / count
+    struct.m2 += weight * delta * (val - struct.mean)
+    struct.count = count
+
+    if val < struct.min:
+        struct.min = val
+
+    if val > struct.max:
+        struct.max = val
+
+
+def _merge(struct, other):
+    # Chan et al. parallel variance
+    count = struct.count + other.count
+    struct.current_count += other.current_count
+
+    if other.count == 0:
+        return
+
+    delta = other.mean - struct.mean
+    struct.mean += delta * other.count / count
+    struct.m2 += other.m2 + delta * delta * struct.count * other.count / count
+    struct.count = count
+    struct.min = min(struct.min, other.min)
+    struct.max = max(struct.max, other.max)
+
+
 class StatStream:
     """
-    Shareable object
-
-    Store the sum of the observations amd the the sum of the observations squared
+    Store the mean of the observations and the sum of their squared differences to the mean (Welford),
+    which stays accurate where the sum of the squares would lose precision.
     The first few observations are discarded (usually slower than the rest)
 
-    The average and the standard deviation is computed at the user's request
+    The average and the standard deviation is computed at the user's request.
+    Streams updated separately, by different workers for example, are combined with :meth:`merge`.
+
+    Parameters
+    ----------
+    shared: bool
+        Store the stream in shared memory so it can be updated by child processes,
+        every access then goes through a lock.
+        By default the stream is a plain python object local to the process.
+
+    sketch: bool or QuantileSketch
+        Also estimate the percentiles with a fixed memory sketch,
+        see :class:`~cantilever.core.sketch.QuantileSketch`
 
-    In order to make the computation stable we store the first observation and subtract it to every other
-    observations. The idea is if x ~ N(mu, sigma)  x - x0 and the sum of x - x0 should be close(r) to 0 allowing
-    for greater precision; without that trick `var` was getting negative on some iteration.
     """
 
-    def __init__(self, drop_first_obs=10):
-        self.struct = Value(
-            StatStreamStruct,
-            0,  # sum
-            0,  # sum_sqr
-            0,  # first_obs
+    __slots__ = ("struct", "shared", "sketch")
+
+    def __init__(self, drop_first_obs=10, shared=False, sketch=False):
+        init = (
+            0.0,  # mean
+            0.0,  # m2
             float("+inf"),  # min
             float("-inf"),  # max
+            0,  # count
             0,  # current_count
-            0,  # current_obs
-            drop_first_obs,
-        )  # drop_obs
+            0.0,  # current_obs
+            drop_first_obs,  # drop_obs
+        )
+        self.shared = shared
+
+        if shared:
+            self.struct = Value(StatStreamStruct, *init)
+        else:
+            self.struct = StatStreamState(*init)
+
+        if sketch is True:
+            sketch = QuantileSketch(shared=shared)
+
+        self.sketch = sketch or None
+
+    def _locked(self):
+        # a single lock for the whole operation instead of one per field
+        if self.shared:
+            return self.struct.get_lock(), self.struct.get_obj()
+        return nullcontext(), self.struct
 
     @classmethod
-    def from_dict(cls, data):
-        cls.struct.sum = data["sum"]
-        cls.struct.sum_sqr = data["sum_sqr"]
-        cls.struct.first_obs = data["first_obs"]
-        cls.struct.min = data["min"]
-        cls.struct.max = data["max"]
-        cls.struct.current_count = data["current_count"]
-        cls.struct.current_obs = data["current_obs"]
-        cls.struct.drop_obs = data["drop_obs"]
-
-        return cls
+    def from_dict(cls, data, **kwargs):
+        """Stream saved with :meth:`state_dict`, of the class it is called on.
+        ``kwargs`` are given to the constructor, ``shared`` or the window ``size`` for example;
+        the window and the weighted mean are not in the dict, :meth:`snapshot` saves them
+        """
+        self = cls(drop_first_obs=data["drop_obs"], **kwargs)
+        lock, struct = self._locked()
+
+        with lock:
+            for name in StatStreamState.__slots__:
+                setattr(struct, name, data[name])
+
+        return self
+
+    kind = 0
+
+    def snapshot(self):
+        """State of the stream as bytes, sketch included, see :meth:`from_snapshot`"""
+        lock, struct = self._locked()
+
+        with lock:
+            parts = [
+                SNAPSHOT.pack(
+                    SNAPSHOT_VERSION,
+                    self.kind,
+                    self.sketch is not None,
+                    *(getattr(struct, name) for name in StatStreamState.__slots__),
+                )
+            ]
+
+            if self.sketch is not None:
+                parts.append(self.sketch.snapshot())
+
+            parts.append(self._snapshot_extra())
+
+        return b"".join(parts)
+
+    def _snapshot_extra(self):
+        return b""
+
+    def _restore_extra(self, buf, offset):
+        pass
+
+    @staticmethod
+    def from_snapshot(buf, shared=False):
+        """Stream saved with :meth:`snapshot`, of the same class"""
+        version, kind, has_sketch, *fields = SNAPSHOT.unpack_from(buf)
+
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {version}")
+
+        # the windowed streams are restored without going through their constructor
+        self = object.__new__(KINDS[kind])
+        self.shared = shared
+
+        if shared:
+            self.struct = Value(StatStreamStruct, *fields)
+        else:
+            self.struct = StatStreamState(*fields)
+
+        offset = SNAPSHOT.size
+        self.sketch = None
+        if has_sketch:
+            self.sketch, offset = QuantileSketch.from_snapshot(buf, offset, shared)
+
+        self._restore_extra(buf, offset)
+        return self
 
     def state_dict(self):
         data = dict()
 
-        data["sum"] = self.struct.sum
-        data["sum_sqr"] = self.struct.sum_sqr
-        data["first_obs"] = self.struct.first_obs
+        data["mean"] = self.struct.mean
+        data["m2"] = self.struct.m2
         data["min"] = self.struct.min
         data["max"] = self.struct.max
+        data["count"] = self.struct.count
         data["current_count"] = self.struct.current_count
         data["current_obs"] = self.struct.current_obs
         data["drop_obs"] = self.struct.drop_obs
@@ -73,11 +224,13 @@ class StatStream:
 
     @property
     def sum(self):
-        return self.struct.sum
+        return self.struct.mean * self.struct.count
 
     @property
     def sum_sqr(self):
-        return self.struct.sum_sqr
+        count = self.struct.count
+        mean = self.struct.mean
+        return self.struct.m2 + count * mean * mean
 
     @property
     def current_count(self):
@@ -99,60 +252,175 @@ class StatStream:
     def drop_obs(self):
         return self.struct.drop_obs
 
-    @property
-    def first_obs(self):
-        return self.struct.first_obs
-
     @property
     def total(self):
-        return self.struct.sum + self.first_obs * self.count
+        return self.sum
 
     def __iadd__(self, other):
         self.update(other, 1)
         return self
 
     def update(self, val, weight=1):
-        self.struct.current_count += weight
-
-        if self.current_count < self.drop_obs:
-            self.struct.current_obs = val
+        if self.shared:
+            with self.struct.get_lock():
+                self._update(self.struct.get_obj(), float(val), weight)
+        else:
+            self._update(self.struct, float(val), weight)
+
+    def _update(self, struct, val, weight):
+        _update(struct, val, weight)
+
+        if self.sketch is not None and struct.current_count > struct.drop_obs:
+            self.sketch.add(val, weight)
+
+    def update_many(self, values, weights=None):
+        """Update the stream with a sequence of observations in one pass,
+        same result as calling :meth:`update` on each of them, dropped observations included.
+        ``values`` and ``weights`` can be NumPy arrays or any object supporting the buffer protocol;
+        without NumPy the observations are added one by one, under a single lock
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+
+        lock, struct = self._locked()
+
+        with lock:
+            if np is None:
+                self._update_each(struct, values, weights)
+            else:
+                self._update_many(np, struct, values, weights)
+
+    def _update_each(self, struct, values, weights):
+        if weights is None:
+            weights = itertools.repeat(1)
+
+        for val, weight in zip(values, weights):
+            self._update(struct, float(val), weight)
+
+    def _update_many(self, np, struct, values, weights):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
             return
 
-        if self.count == 1:
-            self.struct.first_obs = val
+        if weights is None:
+            weights = np.ones(len(values), dtype=np.int64)
+        else:
+            weights = np.asarray(weights).ravel()
 
-        self.struct.current_obs = val - self.first_obs
-        self.struct.sum += float(self.current_obs) * float(weight)
-        self.struct.sum_sqr += float(self.current_obs * self.current_obs) * float(
-            weight
+        if len(weights) != len(values):
+            raise ValueError("values and weights must have the same length")
+
+        # observations are dropped until current_count goes over drop_obs
+        kept = struct.current_count + np.cumsum(weights) > struct.drop_obs
+        x = values[kept]
+        w = weights[kept]
+
+        batch = StatStreamState(
+            0.0,  # mean
+            0.0,  # m2
+            float("+inf"),  # min
+            float("-inf"),  # max
+            0,  # count
+            weights.sum().item(),  # current_count
+            values[-1].item(),  # current_obs
+            struct.drop_obs,  # drop_obs
         )
 
-        self.struct.min = min(self.min, val)
-        self.struct.max = max(self.max, val)
+        count = w.sum().item()
+        if count > 0:
+            mean = np.dot(w, x) / count
+            batch.mean = mean.item()
+            batch.m2 = np.dot(w, (x - mean) ** 2).item()
+            batch.min = x.min().item()
+            batch.max = x.max().item()
+            batch.count = count
+
+        _merge(struct, batch)
+        struct.current_obs = batch.current_obs
+
+        if self.sketch is not None and len(x):
+            self.sketch.add_many(x, w)
+
+    def merge(self, other):
+        """Add the observations of ``other`` to this stream, returns this stream.
+        Only the summaries are combined so workers can be reduced in any order,
+        with :func:`functools.reduce` or as a tree
+        """
+        if type(other).merge is not StatStream.merge:
+            # windowed and weighted states are not summaries Chan's formula can combine
+            raise TypeError(f"{type(other).__name__} cannot be merged")
+
+        if self.sketch is not None and other.sketch is None:
+            raise ValueError(
+                "Cannot merge a stream without sketch into one with a sketch"
+            )
+
+        lock, struct = self._locked()
+        other_lock, other_struct = other._locked()
+
+        with other_lock:
+            other_struct = StatStreamState(
+                *(getattr(other_struct, name) for name in StatStreamState.__slots__)
+            )
+            other_sketch = None
+            if self.sketch is not None:
+                other_sketch = QuantileSketch(
+                    other.sketch.alpha, other.sketch.min_value, other.sketch.max_value
+                )
+                other_sketch.merge(other.sketch)
+
+        with lock:
+            _merge(struct, other_struct)
+
+            if other_sketch is not None:
+                self.sketch.merge(other_sketch)
+
+        return self
 
     @property
     def val(self) -> float:
-        return self.current_obs + self.first_obs
+        return self.current_obs
 
     @property
     def count(self) -> int:
-        # is count is 0 then self.sum is 0 so everything should workout
-        return max(self.current_count - self.drop_obs, 1)
+        # is count is 0 then the mean is 0 so everything should workout
+        return max(self.struct.count, 1)
 
     @property
     def avg(self) -> float:
-        return self.sum / float(self.count) + self.first_obs
+        return self.struct.mean
 
     @property
     def var(self) -> float:
-        avg = self.sum / float(self.count)
-        return self.sum_sqr / float(self.count) - avg * avg
+        return self.struct.m2 / float(self.count)
 
     @property
     def sd(self) -> float:
         return math.sqrt(self.var)
 
+    def percentile(self, p) -> float:
+        """Estimate of the ``p`` percentile, requires a sketch"""
+        if self.sketch is None:
+            raise ValueError("StatStream was created without sketch")
+
+        lock, _ = self._locked()
+        with lock:
+            return self.sketch.quantile(p / 100)
+
+    def percentiles(self, percentiles=PERCENTILES):
+        """``{p50: ..., p95: ..., p99: ...}``, empty without sketch"""
+        if self.sketch is None:
+            return {}
+
+        lock, _ = self._locked()
+        with lock:
+            return self.sketch.percentiles(percentiles)
+
     def to_array(self, transform=None):
+        percentiles = list(self.percentiles().values())
+
         if transform is not None:
             return [
                 transform(self.avg),
@@ -160,8 +428,8 @@ class StatStream:
                 transform(self.min),
                 transform(self.max),
                 self.count,
-            ]
-        return [self.avg, self.sd, self.min, self.max, self.count]
+            ] + [transform(p) for p in percentiles]
+        return [self.avg, self.sd, self.min, self.max, self.count] + percentiles
 
     def to_dict(self):
         data = {
@@ -170,9 +438,257 @@ class StatStream:
             "max": self.max,
             "sd": self.sd,
             "count": self.count,
+            **self.percentiles(),
             "unit": "s",
         }
         return data
 
     def to_json(self):
         return json.dumps(self.to_dict())
+
+
+class WindowStatStream(StatStream):
+    """Statistics of the last ``size`` observations, for live monitoring.
+
+    The observations are kept in a :class:`~cantilever.core.ring.RingBuffer`,
+    the mean and the sum of squared differences are updated incrementally when an observation
+    enters or leaves the window, min and max are computed over the window when requested.
+    The window is local to the process and cannot be merged.
+    """
+
+    __slots__ = ("values", "weights", "mean", "m2", "weight")
+
+    kind = 1
+    # capacity, offset of the ring buffers, mean, m2, weight
+    extra = struct.Struct("<qqddq")
+
+    def __init__(self, size=100, drop_first_obs=10):
+        super().__init__(drop_first_obs)
+        self.values = RingBuffer(size, "d")
+        self.weights = RingBuffer(size, "q")
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.weight = 0
+
+    def _update(self, struct, val, weight):
+        struct.current_count += weight
+        struct.current_obs = val
+
+        if struct.current_count <= struct.drop_obs:
+            return
+
+        values = self.values
+
+        if len(values) == values.capacity:
+            self._remove(values[values.offset], self.weights[values.offset])
+
+        values.append(val)
+        self.weights.append(weight)
+        self._add(val, weight)
+
+        # recompute from scratch once per window so the rounding errors do not accumulate
+        if values.offset % values.capacity == 0:
+            self._recompute()
+
+    def _add(self, val, weight):
+        self.weight += weight
+        delta = val - self.mean
+        self.mean += delta * weight / self.weight
+        self.m2 += weight * delta * (val - self.mean)
+
+    def _remove(self, val, weight):
+        previous = self.mean
+        self.weight -= weight
+
+        if self.weight <= 0:
+            self.mean, self.m2, self.weight = 0.0, 0.0, 0
+            return
+
+        self.mean = (previous * (self.weight + weight) - val * weight) / self.weight
+        self.m2 = max(self.m2 - weight * (val - self.mean) * (val - previous), 0.0)
+
+    def _recompute(self):
+        self.mean, self.m2, self.weight = 0.0, 0.0, 0
+
+        for val, weight in zip(self.values.to_list(), self.weights.to_list()):
+            self._add(val, weight)
+
+    def _update_many(self, np, struct, values, weights):
+        # every observation goes through the window
+        self._update_each(struct, values, weights)
+
+    def _snapshot_extra(self):
+        values = self.values
+        header = self.extra.pack(
+            values.capacity, values.offset, self.mean, self.m2, self.weight
+        )
+        return (
+            header + _little_endian(values.array) + _little_endian(self.weights.array)
+        )
+
+    def _restore_extra(self, buf, offset):
+        size, ring_offset, self.mean, self.m2, self.weight = self.extra.unpack_from(
+            buf, offset
+        )
+        offset += self.extra.size
+
+        self.values = RingBuffer(size, "d")
+        self.weights = RingBuffer(size, "q")
+
+        for ring in (self.values, self.weights):
+            ring.array = _from_little_endian(
+                ring.array.typecode, buf[offset : offset + size * 8]
+            )
+            ring.offset = ring_offset
+            offset += size * 8
+
+    def merge(self, other):
+        raise TypeError("Windowed statistics cannot be merged")
+
+    @property
+    def min(self):
+        return min(self.values.to_list(), default=float("+inf"))
+
+    @property
+    def max(self):
+        return max(self.values.to_list(), default=float("-inf"))
+
+    @property
+    def count(self) -> int:
+        return max(self.weight, 1)
+
+    @property
+    def avg(self) -> float:
+        return self.mean
+
+    @property
+    def var(self) -> float:
+        return self.m2 / float(self.count)
+
+    @property
+    def total(self):
+        return self.mean * self.weight
+
+
+class EWMStatStream(StatStream):
+    """Exponentially weighted mean and variance, recent observations weigh more.
+
+    An observation of weight ``w`` moves the mean by ``1 - (1 - alpha) ** w`` of its distance to it.
+    min, max, count and total still cover every observation.
+    The stream is local to the process and cannot be merged.
+
+    Parameters
+    ----------
+    alpha: float
+        Weight of the newest observation
+
+    halflife: float
+        Number of observations after which an observation has lost half of its weight,
+        used instead of ``alpha``
+
+    """
+
+    __slots__ = ("alpha", "mean", "variance")
+
+    kind = 2
+    extra = struct.Struct("<ddd")
+
+    def __init__(self, alpha=0.1, halflife=None, drop_first_obs=10):
+        super().__init__(drop_first_obs)
+
+        if halflife is not None:
+            alpha = 1 - 0.5 ** (1 / halflife)
+
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha must be in (0, 1], or halflife > 0")
+
+        self.alpha = alpha
+        self.mean = 0.0
+        self.variance = 0.0
+
+    def _update(self, struct, val, weight):
+        super()._update(struct, val, weight)
+
+        if struct.current_count <= struct.drop_obs:
+            return
+
+        if struct.count == weight:
+            # first observation
+            self.mean = val
+            self.variance = 0.0
+            return
+
+        alpha = 1 - (1 - self.alpha) ** weight
+        delta = val - self.mean
+        self.mean += alpha * delta
+        self.variance = (1 - alpha) * (self.variance + alpha * delta * delta)
+
+    def _update_many(self, np, struct, values, weights):
+        # the decay depends on the order of the observations
+        self._update_each(struct, values, weights)
+
+    def _snapshot_extra(self):
+        return self.extra.pack(self.alpha, self.mean, self.variance)
+
+    def _restore_extra(self, buf, offset):
+        self.alpha, self.mean, self.variance = self.extra.unpack_from(buf, offset)
+
+    def merge(self, other):
+        raise TypeError("Exponentially weighted statistics cannot be merged")
+
+    @property
+    def avg(self) -> float:
+        return self.mean
+
+    @property
+    def var(self) -> float:
+        return self.variance
+
+
+def _little_endian(values):
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_little_endian(typecode, buf):
+    values = array(typecode, bytes(buf))
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+KINDS = {cls.kind: cls for cls in (StatStream, WindowStatStream, EWMStatStream)}
+
+
+def pack_tree(entries):
+    """Pack ``[(name, bytes)]``, the snapshots of a tree of streams, into bytes"""
+    parts = [LENGTH.pack(len(entries))]
+
+    for name, data in entries:
+        name = name.encode()
+        parts.extend([LENGTH.pack(len(name)), name, LENGTH.pack(len(data)), data])
+
+    return b"".join(parts)
+
+
+def unpack_tree(buf):
+    """Returns the ``[(name, bytes)]`` packed by :func:`pack_tree`"""
+    buf = memoryview(buf)
+    (count,) = LENGTH.unpack_from(buf)
+    offset = LENGTH.size
+    entries = []
+
+    for _ in range(count):
+        (size,) = LENGTH.unpack_from(buf, offset)
+        offset += LENGTH.size
+        name = str(buf[offset : offset + size], "utf-8")
+        offset += size
+
+        (size,) = LENGTH.unpack_from(buf, offset)
+        offset += LENGTH.size
+        entries.append((name, buf[offset : offset + size]))
+        offset += size
+
+    return entries
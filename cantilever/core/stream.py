@@ -0,0 +1,294 @@
+"""Small push based stream operators
+
+Covers the few reactivex operators used to process perf counter events.
+Values travel through the pipeline in batches, each operator transforms a whole batch at once.
+
+.. code-block:: python
+
+   from cantilever.core import stream as ops
+
+   def metrics(source, observer, scheduler):
+       source.pipe(
+           ops.filter(lambda obj: obj.get("name") == "batch"),
+           ops.rate(lambda obj: obj["batch_size"], lambda obj: obj["time"]),
+           ops.window_average(10),
+       ).subscribe(on_next=print)
+
+"""
+
+import traceback
+from collections import deque
+
+
+class Operator:
+    """Transform a batch of values into a new batch, state can be kept between batches
+
+    ``batch`` must leave the state unchanged when it raises,
+    the values of a failed batch are then given one at a time so only the faulty ones are lost.
+    """
+
+    def batch(self, values):
+        return values
+
+    def completed(self):
+        """Values emitted when the stream completes"""
+        return []
+
+
+class _Filter(Operator):
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def batch(self, values):
+        predicate = self.predicate
+        return [v for v in values if predicate(v)]
+
+
+class _Map(Operator):
+    def __init__(self, fun):
+        self.fun = fun
+
+    def batch(self, values):
+        fun = self.fun
+        return [fun(v) for v in values]
+
+
+class _Pairwise(Operator):
+    def __init__(self):
+        self.previous = []
+
+    def batch(self, values):
+        if not values:
+            return values
+
+        values = self.previous + values
+        self.previous = values[-1:]
+        return list(zip(values, values[1:]))
+
+
+def _identity(value):
+    return value
+
+
+class _Average(Operator):
+    def __init__(self, key):
+        self.key = key or _identity
+        self.total = 0
+        self.count = 0
+
+    def batch(self, values):
+        key = self.key
+        self.total += sum(key(v) for v in values)
+        self.count += len(values)
+        return []
+
+    def completed(self):
+        if self.count == 0:
+            return []
+        return [self.total / self.count]
+
+
+class _WindowAverage(Operator):
+    def __init__(self, size, key):
+        self.key = key or _identity
+        self.window = deque(maxlen=size)
+        self.total = 0
+
+    def batch(self, values):
+        # keys first, the window is untouched if one of them raises
+        values = [self.key(v) for v in values]
+        window = self.window
+        size = window.maxlen
+        result = []
+
+        for v in values:
+            if len(window) == size:
+                self.total -= window[0]
+
+            window.append(v)
+            self.total += v
+            result.append(self.total / len(window))
+
+        return result
+
+
+class _Rate(Operator):
+    def __init__(self, count, time, unit):
+        self.count = count
+        self.time = time
+        self.unit = unit
+        self.previous = None
+
+    def batch(self, values):
+        count = self.count
+        time = self.time
+        unit = self.unit
+        previous = self.previous
+        result = []
+
+        for v in values:
+            if previous is not None:
+                elapsed = (time(v) - time(previous)) * unit
+                result.append(count(previous) / elapsed if elapsed > 0 else 0.0)
+            previous = v
+
+        self.previous = previous
+        return result
+
+
+def filter(predicate):
+    """Only keep the values for which ``predicate(value)`` is true"""
+    return _Filter(predicate)
+
+
+def map(fun):
+    """Replace each value by ``fun(value)``"""
+    return _Map(fun)
+
+
+def pairwise():
+    """Emit ``(previous, current)`` for each value but the first"""
+    return _Pairwise()
+
+
+def average(key=None):
+    """Emit the average of all the values when the stream completes"""
+    return _Average(key)
+
+
+def window_average(size, key=None):
+    """Emit the average of the last ``size`` values, for each value"""
+    return _WindowAverage(size, key)
+
+
+def rate(count=None, time=None, unit=1e-9):
+    """Emit ``count(previous) / (time(current) - time(previous))`` for each value but the first
+
+    Parameters
+    ----------
+    count:
+        Work done by an event, defaults to 1
+
+    time:
+        Timestamp of an event, defaults to ``value["time"]``
+
+    unit: float
+        Converts the time difference to seconds, default for nanosecond timestamps
+
+    """
+    return _Rate(count or (lambda v: 1), time or (lambda v: v["time"]), unit)
+
+
+class Subscriber:
+    def __init__(self, on_next=None, on_error=None, on_completed=None, on_batch=None):
+        self.on_next = on_next
+        self.on_error = on_error
+        self.on_completed = on_completed
+        self.on_batch = on_batch
+
+
+class Stream:
+    """A stage of the pipeline, values pushed to it go through its operator
+    then to the downstream stages and subscribers
+    """
+
+    def __init__(self, operator=None):
+        self.operator = operator or Operator()
+        self.children = []
+        self.subscribers = []
+
+    def pipe(self, *operators):
+        """Chain operators, returns the last stage"""
+        stream = self
+        for operator in operators:
+            if not isinstance(operator, Operator):
+                raise TypeError(
+                    f"{operator!r} is not a cantilever.core.stream operator, "
+                    "use RxSource to pipe reactivex operators"
+                )
+
+            child = Stream(operator)
+            stream.children.append(child)
+            stream = child
+        return stream
+
+    def subscribe(self, on_next=None, on_error=None, on_completed=None, on_batch=None):
+        """Receive the values of this stage, ``on_batch`` receives them a batch at a time"""
+        self.subscribers.append(Subscriber(on_next, on_error, on_completed, on_batch))
+        return self
+
+    def on_next(self, value):
+        self.on_batch([value])
+
+    def on_batch(self, values):
+        try:
+            result = self.operator.batch(values)
+        except Exception as error:
+            if len(values) == 1:
+                self.on_error(error)
+                return
+
+            result = self._each(values)
+
+        self._emit(result)
+
+    def _each(self, values):
+        # the batch failed, retry value by value to keep the ones that do not fail
+        result = []
+        for v in values:
+            try:
+                result.extend(self.operator.batch([v]))
+            except Exception as error:
+                self.on_error(error)
+
+        return result
+
+    def _emit(self, values):
+        if not values:
+            return
+
+        for child in self.children:
+            child.on_batch(values)
+
+        for subscriber in self.subscribers:
+            try:
+                if subscriber.on_batch is not None:
+                    subscriber.on_batch(values)
+
+                elif subscriber.on_next is not None:
+                    on_next = subscriber.on_next
+                    for v in values:
+                        on_next(v)
+
+            except Exception as error:
+                _error(subscriber, error)
+
+    def on_error(self, error):
+        for child in self.children:
+            child.on_error(error)
+
+        for subscriber in self.subscribers:
+            _error(subscriber, error)
+
+    def on_completed(self):
+        try:
+            values = self.operator.completed()
+        except Exception as error:
+            self.on_error(error)
+            values = []
+
+        self._emit(values)
+
+        for child in self.children:
+            child.on_completed()
+
+        for subscriber in self.subscribers:
+            if subscriber.on_completed is not None:
+                subscriber.on_completed()
+
+
+def _error(subscriber, error):
+    if subscriber.on_error is not None:
+        subscriber.on_error(error)
+    else:
+        traceback.print_exception(type(error), error, error.__traceback__)
@@ -5,7 +5,13 @@ from contextlib import contextmanager
 from dataclasses import dataclass, field
 from threading import get_native_id
 
-from .statstream import StatStream
+from .statstream import (
+    EWMStatStream,
+    StatStream,
+    WindowStatStream,
+    pack_tree,
+    unpack_tree,
+)
 
 profile = dict()
 
@@ -33,8 +39,14 @@ class Value:
 
 
 class StatStreamValue:
+    shared = False
+    sketch = False
+
     def __init__(self) -> None:
-        self.value = StatStream(0)
+        self.value = self.make_stream()
+
+    def make_stream(self):
+        return StatStream(0, shared=self.shared, sketch=self.sketch)
 
     def set(self, value):
         self.value.update(value, weight=1)
@@ -43,6 +55,36 @@ class StatStreamValue:
         return self.value.current_obs
 
 
+class SharedStatStreamValue(StatStreamValue):
+    """Timings stored in shared memory, they can be updated by child processes"""
+
+    shared = True
+
+
+class SketchStatStreamValue(StatStreamValue):
+    """Timings with their p50, p95 and p99, shown as extra columns"""
+
+    sketch = True
+
+
+class WindowStatStreamValue(StatStreamValue):
+    """Statistics of the last ``window`` timings"""
+
+    window = 100
+
+    def make_stream(self):
+        return WindowStatStream(self.window, 0)
+
+
+class EWMStatStreamValue(StatStreamValue):
+    """Exponentially weighted statistics of the timings"""
+
+    alpha = 0.1
+
+    def make_stream(self):
+        return EWMStatStream(self.alpha, drop_first_obs=0)
+
+
 @dataclass
 class DisplayConfig:
     decimal_format: str = "8.2"
@@ -103,6 +145,8 @@ class TimerGroup:
                 col_sep,
                 f"{'count':>{size}}",
             ]
+            for name in self.timing.value.percentiles():
+                header.extend([col_sep, f"{name:>{size}}"])
             print(f"# {' ' * 40} {' '.join(header)}")
         else:
             print(f"# {' ' * 40} | latest")
@@ -123,6 +167,8 @@ class TimerGroup:
                 col_sep,
                 f"{stat.count:{df}f}",
             ]
+            for value in stat.percentiles().values():
+                stats.extend([col_sep, f"{value:{df}f}"])
             return " ".join(stats)
 
         return f"{self.latest():5.2f}"
@@ -142,6 +188,30 @@ class TimerGroup:
             for _, v in self.subgroups.items():
                 v.show(depth + 1, config=config)
 
+    def snapshot(self):
+        """Timings of the group and its subgroups as bytes, to be saved alongside a checkpoint"""
+        timing = b""
+        if isinstance(self.timing, StatStreamValue):
+            timing = self.timing.value.snapshot()
+
+        # the first entry is the timing of this group
+        return pack_tree(
+            [(self.name, timing)]
+            + [(name, group.snapshot()) for name, group in self.subgroups.items()]
+        )
+
+    def restore(self, data):
+        """Restore the timings saved with :meth:`snapshot`, missing subgroups are created"""
+        (_, timing), *subgroups = unpack_tree(data)
+
+        if timing and isinstance(self.timing, StatStreamValue):
+            self.timing.value = StatStream.from_snapshot(
+                timing, shared=self.timing.shared
+            )
+
+        for name, snapshot in subgroups:
+            self.timeit(name).restore(snapshot)
+
     def iterator(self, iterator):
         while True:
             with self.timeit("next"):
@@ -0,0 +1,120 @@
+"""Live view of the PerfCounter running on this machine
+
+.. code-block:: bash
+
+   python -m cantilever.core.top --interval 1 --directory /scratch/rings
+
+"""
+
+import argparse
+import time
+
+from .perfcounter_shm import CounterView, discover
+from .report import PrintTable
+
+COLUMNS = [
+    "Name",
+    "Pid",
+    "On",
+    "Size",
+    "Depth",
+    "High water",
+    "Objects in/s",
+    "Records in/s",
+    "Records out/s",
+    "Dropped",
+    "Overwritten",
+]
+
+
+def snapshot(directories=()):
+    stats = []
+
+    for name in discover(directories):
+        try:
+            with CounterView(name) as view:
+                stats.append(view.stats())
+        except (OSError, ValueError):
+            # the counter exited between discovery and attach
+            continue
+
+    return stats
+
+
+def rates(stat, previous, now):
+    """Objects pushed, records pushed and records consumed per second;
+    an object takes a header record plus one record per field
+    """
+    prev = previous.get(stat["name"])
+
+    if prev is None:
+        return 0.0, 0.0, 0.0
+
+    elapsed = now - prev[0]
+    return (
+        (stat["objects"] - prev[1]) / elapsed,
+        (stat["index_in"] - prev[2]) / elapsed,
+        (stat["index_out"] - prev[3]) / elapsed,
+    )
+
+
+def make_table(stats, previous, now):
+    table = []
+
+    for stat in stats:
+        objects_in, records_in, records_out = rates(stat, previous, now)
+        table.append(
+            [
+                stat["name"],
+                stat["pid"],
+                stat["on"],
+                stat["size"],
+                stat["depth"],
+                stat["high_water"],
+                objects_in,
+                records_in,
+                records_out,
+                stat["dropped"],
+                stat["overwritten"],
+            ]
+        )
+
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--interval", type=float, default=1, help="refresh interval")
+    parser.add_argument(
+        "--directory",
+        action="append",
+        default=[],
+        help="directory holding file backed rings",
+    )
+    parser.add_argument("--once", action="store_true", help="print a single view")
+    args = parser.parse_args(argv)
+
+    previous = dict()
+
+    while True:
+        now = time.monotonic()
+        stats = snapshot(args.directory)
+        table = make_table(stats, previous, now)
+        previous = {
+            s["name"]: (now, s["objects"], s["index_in"], s["index_out"]) for s in stats
+        }
+
+        if not args.once:
+            # clear the terminal
+            print("\033[2J\033[H", end="")
+
+        PrintTable(COLUMNS, table).print(mode="md")
+
+        if args.once:
+            break
+
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,10 @@ with open("cantilever/core/__init__.py") as file:
             version = line.split("=")[1].strip().replace('"', "")
             break
 
-extra_requires = {"plugins": ["importlib_resources"]}
+extra_requires = {
+    "plugins": ["importlib_resources"],
+    "reactivex": ["reactivex"],
+}
 extra_requires["all"] = sorted(set(sum(extra_requires.values(), [])))
 
 if __name__ == "__main__":
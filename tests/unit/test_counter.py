@@ -1,7 +1,13 @@
+import asyncio
+import importlib
+import os
+import queue
 import time
 
+import pytest
 
-from reactivex import operators as ops
+
+from cantilever.core import stream as ops
 
 
 def fibonacci_of(nn):
@@ -63,6 +69,605 @@ def test_counters_shm():
             counter.push_object(name="batch", time=time.time_ns(), batch_size=1024)
             fake_work()
 
+    report_consumer_cpu(counter)
+
+
+def test_shm_ring_layout():
+    from cantilever.core.perfcounter_shm import VALUE_SIZE, RingLayout
+
+    size, key_size, max_keys = 4, 16, 3
+    buf = memoryview(bytearray(RingLayout.nbytes(size, key_size, max_keys)))
+    producer = RingLayout.create(buf, size, key_size, max_keys)
+    consumer = RingLayout.attach(buf)
+    assert (consumer.size, consumer.key_size) == (size, key_size)
+
+    producer.write(0, "batch_size", 1024)
+    producer.write(1, "name", "batch")
+    producer.write(size + 2, "batch_size", -1)
+
+    assert consumer.read(0)[1:] == ("batch_size", 1024)
+    assert consumer.read(1)[1:] == ("name", "batch")
+    assert consumer.read(2)[1:] == ("batch_size", -1)
+    assert consumer.keys == ["batch_size", "name"]
+
+    for value in (0.125, True, b"\0ab", "é", 2**63 - 1):
+        producer.write(3, "value", value)
+        assert consumer.read(3)[2] == value
+        assert type(consumer.read(3)[2]) is type(value)
+
+    with pytest.raises(ValueError):
+        producer.write(0, "name", "x" * (VALUE_SIZE + 1))
+
+    with pytest.raises(TypeError):
+        producer.write(0, "name", None)
+
+    with pytest.raises(ValueError):
+        producer.write(0, "k" * (key_size + 1), 0)
+
+    with pytest.raises(ValueError):
+        producer.write(0, "time", 0)
+
+    producer.release()
+    consumer.release()
+
+
+def test_shm_framing():
+    from cantilever.core.perfcounter_shm import RecordBatch, RingLayout
+
+    size = 8
+    buf = memoryview(bytearray(RingLayout.nbytes(size, 16, 8)))
+    ring = RingLayout.create(buf, size, 16, 8)
+
+    # objects do not need to start with a name, the last one is complete
+    index = ring.write_object(0, dict(step=0, loss=0.5))
+    index = ring.write_object(index, dict(name="batch", step=1))
+    end = ring.write_object(index, dict(step=2))
+    assert end == 8
+
+    batch = RecordBatch(ring, ring.chunks(0, end))
+    assert [record_id for _, record_id, _ in batch.frames()] == [0, 1, 2]
+    assert list(batch.objects()) == [
+        dict(step=0, loss=0.5),
+        dict(name="batch", step=1),
+        dict(step=2),
+    ]
+    assert list(batch.objects(lambda k, v: k == "step")) == [
+        dict(step=0, loss=0.5),
+        dict(step=2),
+    ]
+
+    # the fields of an object whose header was overwritten are skipped
+    batch.skip(1)
+    assert list(batch.objects()) == [dict(name="batch", step=1), dict(step=2)]
+
+    batch.release()
+    ring.release()
+
+
+def report_consumer_cpu(counter):
+    # the observer should not steal a core from the workload
+    print(f"consumer cpu: {counter.consumer_cpu_time:.4f} s")
+    assert counter.consumer_cpu_time is not None
+
+
+def push_latency(counter, count):
+    timings = []
+    for i in range(count):
+        s = time.perf_counter_ns()
+        counter.push("batch_size", i)
+        timings.append(time.perf_counter_ns() - s)
+
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.99)]
+
+
+def test_shm_push_latency():
+    from cantilever.core.perfcounter_shm import Observer, PerfCounter
+
+    results = {}
+    for spsc in (False, True):
+        with PerfCounter(Observer, (), 20000, spsc=spsc) as counter:
+            results[spsc] = push_latency(counter, 10000)
+
+    for spsc, (p50, p99) in results.items():
+        print(f"spsc={spsc!s:>5} push p50: {p50:6d} ns p99: {p99:6d} ns")
+
+
+def test_counters_shm_spsc():
+    from cantilever.core.perfcounter_shm import PerfCounter, Source
+
+    with PerfCounter(Source, (metrics,), qsize, spsc=True) as counter:
+        for _ in range(n):
+            counter.push_object(name="batch", time=time.time_ns(), batch_size=1024)
+            fake_work()
+
+    report_consumer_cpu(counter)
+
+
+def test_counters_shm_spsc_single_producer(monkeypatch):
+    import threading
+
+    from cantilever.core import perfcounter_shm
+    from cantilever.core.perfcounter_shm import Observer, PerfCounter
+
+    errors = []
+
+    def producer():
+        try:
+            counter.push_object(step=1)
+        except RuntimeError as error:
+            errors.append(error)
+
+    with PerfCounter(Observer, (), qsize, spsc=True) as counter:
+        counter.push_object(step=0)
+
+        thread = threading.Thread(target=producer)
+        thread.start()
+        thread.join()
+
+    assert len(errors) == 1
+
+    # weaker memory models use the locks
+    monkeypatch.setattr(perfcounter_shm, "ORDERED_STORES", False)
+
+    with pytest.warns(UserWarning):
+        assert not PerfCounter(Observer, (), qsize, spsc=True).spsc
+
+    with pytest.raises(ValueError):
+        PerfCounter(Observer, (), qsize, backpressure="overwrite")
+
+
+def test_counters_shm_waiter_timeout():
+    from cantilever.core.backoff import AdaptiveWait
+    from cantilever.core.perfcounter_shm import Observer, PerfCounter
+
+    # a missed wakeup would never be recovered from
+    with pytest.raises(ValueError):
+        PerfCounter(Observer, (), qsize, waiter=AdaptiveWait(timeout=None))
+
+
+class CountRecords:
+    """Count what reaches the observer and save it when the worker exits"""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        with open(self.path, "w") as fp:
+            fp.write(str(self.count))
+
+
+class SlowCountRecords(CountRecords):
+    def __call__(self, *args):
+        time.sleep(0.001)
+        super().__call__(*args)
+
+
+class SlowBatches(CountRecords):
+    def on_batch(self, batch):
+        time.sleep(0.001)
+        self.count += len(batch)
+
+
+def test_counters_shm_wait_batches(tmp_path):
+    import threading
+
+    from cantilever.core.perfcounter_shm import PerfCounter
+
+    path = tmp_path / "count"
+    stop = threading.Event()
+
+    def produce():
+        while not stop.is_set():
+            counter.push("step", 1)
+            time.sleep(0.0001)
+
+    with PerfCounter(SlowBatches, (path,), 200000) as counter:
+        producer = threading.Thread(target=produce)
+        producer.start()
+        time.sleep(0.05)
+
+        # the worker drains several records per batch, past the index seen by wait()
+        waiting = threading.Thread(target=counter.wait)
+        waiting.start()
+        waiting.join(timeout=5)
+        done = not waiting.is_alive()
+
+        stop.set()
+        producer.join()
+
+    waiting.join()
+    assert done
+
+
+def push_batched(counter, steps, flush_every):
+    for _ in range(steps // flush_every):
+        # a header and 3 fields per object
+        batch = counter.reserve(4 * flush_every)
+        for _ in range(flush_every):
+            batch.push_object(name="batch", time=time.time_ns(), batch_size=1024)
+        counter.commit(batch)
+
+    counter.push_many(
+        dict(name="batch", time=time.time_ns(), batch_size=1024) for _ in range(steps)
+    )
+
+
+@pytest.mark.parametrize(
+    "backend,records_per_object",
+    [("perfcounter_shm", 3), ("perfcounter_queue", 1), ("perfcounter_thread", 1)],
+)
+def test_counters_push_many(tmp_path, backend, records_per_object):
+    module = importlib.import_module(f"cantilever.core.{backend}")
+    path = tmp_path / "count"
+
+    with module.PerfCounter(CountRecords, (path,), qsize) as counter:
+        push_batched(counter, 20, 5)
+
+    assert int(path.read_text()) == 40 * records_per_object
+
+
+backends = ["perfcounter_shm", "perfcounter_queue", "perfcounter_thread"]
+
+
+def unbatched(backend):
+    # the queue backend batches events on the producer side, which hides the pressure
+    if backend == "perfcounter_queue":
+        return dict(batch_size=1)
+    return dict()
+
+
+class CountBatches(CountRecords):
+    def on_batch(self, batch):
+        self.count += len(batch)
+
+
+@pytest.mark.parametrize(
+    "backend,records_per_object",
+    [("perfcounter_shm", 4), ("perfcounter_queue", 1), ("perfcounter_thread", 1)],
+)
+def test_counters_on_batch(tmp_path, backend, records_per_object):
+    module = importlib.import_module(f"cantilever.core.{backend}")
+    path = tmp_path / "count"
+
+    with module.PerfCounter(CountBatches, (path,), qsize) as counter:
+        push_batched(counter, 20, 5)
+
+    assert int(path.read_text()) == 40 * records_per_object
+
+
+class SumLoss:
+    def __init__(self, path):
+        self.path = path
+        self.total = 0
+
+    def on_batch(self, batch):
+        loss = batch.key_id("loss")
+
+        for records in batch.numpy():
+            self.total += records["float"][records["key"] == loss].sum()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        with open(self.path, "w") as fp:
+            fp.write(str(self.total))
+
+
+def test_counters_shm_on_batch_numpy(tmp_path):
+    pytest.importorskip("numpy")
+    from cantilever.core.perfcounter_shm import PerfCounter
+
+    path = tmp_path / "total"
+
+    # small ring so the records wrap around
+    with PerfCounter(
+        SumLoss, (path,), 7, backpressure="block", block_timeout=5
+    ) as counter:
+        for _ in range(100):
+            counter.push_object(name="batch", loss=0.5)
+
+    assert float(path.read_text()) == 50
+
+
+@pytest.mark.parametrize("policy", ["drop", "overwrite", "sample", "block"])
+@pytest.mark.parametrize("backend", backends)
+def test_counters_backpressure(tmp_path, backend, policy):
+    module = importlib.import_module(f"cantilever.core.{backend}")
+    path = tmp_path / "count"
+    steps = 200
+
+    with module.PerfCounter(
+        SlowCountRecords, (path,), 16, backpressure=policy, **unbatched(backend)
+    ) as counter:
+        for i in range(steps):
+            counter.push_object(step=i)
+
+    counters = counter.counters()
+    print(policy, counters)
+
+    delivered = int(path.read_text())
+    assert delivered + counters["dropped"] + counters["overwritten"] == steps
+    assert 0 <= counters["high_water"] <= 16
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_counters_backpressure_raise(tmp_path, backend):
+    module = importlib.import_module(f"cantilever.core.{backend}")
+
+    with pytest.raises((module.Backpressure, queue.Full)):
+        with module.PerfCounter(
+            SlowCountRecords,
+            (tmp_path / "count",),
+            16,
+            backpressure="raise",
+            **unbatched(backend),
+        ) as counter:
+            for i in range(200):
+                counter.push_object(step=i)
+
+
+@pytest.mark.parametrize("backend", ["perfcounter_queue", "perfcounter_thread"])
+def test_counters_idle_and_exit(tmp_path, backend):
+    module = importlib.import_module(f"cantilever.core.{backend}")
+    path = tmp_path / "count"
+
+    with module.PerfCounter(CountRecords, (path,), qsize) as counter:
+        counter.push_object(step=0)
+        counter.wait()
+        time.sleep(0.5)
+
+        s = time.perf_counter()
+
+    exit_time = time.perf_counter() - s
+    print(f"exit: {exit_time * 1000:.2f} ms")
+
+    assert int(path.read_text()) == 1
+    # the idle worker is blocked on the queue
+    assert counter.consumer_cpu_time < 0.25
+    assert exit_time < 0.1
+
+
+class Steps(CountRecords):
+    def __init__(self, steps):
+        super().__init__(None)
+        self.steps = steps
+
+    def __call__(self, obj):
+        self.steps.append((obj["thread"], obj["step"]))
+
+    def __exit__(self, *args):
+        pass
+
+
+@pytest.mark.parametrize("merge", [False, True])
+def test_counters_thread_producers(merge):
+    import threading
+
+    from cantilever.core.perfcounter_thread import PerfCounter
+
+    steps = []
+    with PerfCounter(Steps, (steps,), 1000, merge=merge) as counter:
+
+        def producer(thread):
+            for i in range(500):
+                counter.push_object(thread=thread, step=i)
+
+        threads = [threading.Thread(target=producer, args=(t,)) for t in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    # delivered in order for each thread
+    for t in range(4):
+        assert [i for thread, i in steps if thread == t] == list(range(500))
+
+
+def test_counters_thread_merge():
+    import threading
+
+    from cantilever.core.perfcounter_thread import PerfCounter
+
+    steps = []
+    with PerfCounter(Steps, (steps,), 1000, merge=True) as counter:
+        # every step is pushed from a different thread
+        for i in range(200):
+            thread = threading.Thread(
+                target=lambda: counter.push_object(thread=0, step=i)
+            )
+            thread.start()
+            thread.join()
+
+    assert steps == [(0, i) for i in range(200)]
+
+
+class CountObjects(CountRecords):
+    """Same observer for every backend"""
+
+    def __call__(self, obj):
+        assert obj["name"] == "batch"
+        self.count += 1
+
+
+class CountObjectBatches(CountObjects):
+    def on_batch(self, objects):
+        for obj in objects:
+            self(obj)
+
+
+@pytest.mark.parametrize("observer", [CountObjects, CountObjectBatches])
+@pytest.mark.parametrize("backend", ["thread", "queue", "shm"])
+def test_perfcounter_backends(tmp_path, backend, observer):
+    from cantilever.core.perfcounter import PerfCounter
+
+    path = tmp_path / "count"
+
+    with PerfCounter(observer, (path,), backend=backend, size=qsize) as counter:
+        push_batched(counter, 20, 5)
+
+    assert int(path.read_text()) == 40
+
+
+def test_perfcounter_auto(tmp_path):
+    from cantilever.core import perfcounter
+
+    results = perfcounter.calibrate(count=200)
+    print(results)
+    # shm cannot store every value, it is never selected on its own
+    assert set(results) == {"thread", "queue"}
+
+    fake = dict(
+        thread=dict(push=1e-6, throughput=1e5),
+        shm=dict(push=2e-6, throughput=1e6),
+    )
+    assert perfcounter.select_backend(None, fake) == "thread"
+    assert perfcounter.select_backend(5e5, fake) == "shm"
+    assert perfcounter.select_backend(1e7, fake) == "shm"
+
+    path = tmp_path / "count"
+    perfcounter._calibration = results
+
+    with perfcounter.PerfCounter(CountObjects, (path,), spsc=True) as counter:
+        push_batched(counter, 20, 5)
+        counter.push_object(name="batch", loss=None, shape=[1, 2])
+
+    assert int(path.read_text()) == 41
+
+
+def test_perfbench(tmp_path):
+    from cantilever.core import perfbench
+
+    results = perfbench.sweep(events=200, rates=(0, 20000), producers=(1, 2))
+
+    path = tmp_path / "bench.json"
+    perfbench.save(results, path)
+    assert perfbench.load(path) == results
+
+    for result in results:
+        lost = result["dropped"] + result["overwritten"]
+        assert result["delivered"] + lost == result["events"]
+
+    assert perfbench.compare(results, results) == []
+
+    slower = [dict(r, push_mean_ns=r["push_mean_ns"] * 2) for r in results]
+    assert len(perfbench.compare(results, slower)) == len(results)
+
+
+class CrashOnEnter:
+    def __enter__(self):
+        os._exit(1)
+
+    def __exit__(self, *args):
+        pass
+
+
+class Collect(CountRecords):
+    def __init__(self):
+        super().__init__(None)
+        self.records = []
+
+    def __call__(self, key, value):
+        self.records.append((key, value))
+
+    def __exit__(self, *args):
+        pass
+
+
+def test_counters_shm_never_raises(tmp_path):
+    from cantilever.core.perfcounter_shm import KeyTableFull, PerfCounter
+
+    path = tmp_path / "count"
+    with PerfCounter(
+        CountRecords, (path,), 16, max_keys=2, backpressure="block", block_timeout=5
+    ) as counter:
+        counter.push_object(step=0, loss=0.5)
+        counter.push_object(step=1, epoch=0)
+        counter.push("epoch", 0)
+
+        # larger than the ring, published in chunks
+        counter.push_many(dict(step=i, loss=0.5) for i in range(20))
+
+        # an ordinary name fits, then values the ring cannot store
+        counter.push_object(step=0, loss="validation")
+        counter.push_object(step=0, loss="x" * 100)
+        counter.push_object(step=0, loss=None)
+        counter.push("loss", [0.5])
+        counter.push_many([dict(step=0), dict(step=0, loss={}), dict(step=2**64)])
+
+    assert counter.counters()["dropped"] == 2 + 5
+    assert int(path.read_text()) == 2 + 20 * 2 + 2 + 1
+
+    with pytest.raises(KeyTableFull):
+        with PerfCounter(
+            CountRecords, (path,), 16, max_keys=1, backpressure="raise"
+        ) as counter:
+            counter.push_object(step=0, loss=0.5)
+
+    with pytest.raises(TypeError):
+        with PerfCounter(CountRecords, (path,), 16, backpressure="raise") as counter:
+            counter.push_many([dict(step=0), dict(step=None), dict(step=2)])
+
+    # the object written before the refused one is delivered
+    assert int(path.read_text()) == 1
+
+
+def test_counters_shm_file_replay(tmp_path):
+    from cantilever.core.perfcounter_shm import PerfCounter, replay
+
+    with PerfCounter(CrashOnEnter, (), qsize, directory=tmp_path) as counter:
+        for i in range(10):
+            counter.push_object(name="batch", step=i, loss=0.5)
+
+    # the worker died, the records are still on disk
+    observer = Collect()
+    assert replay(counter.path, observer) == 10
+    assert observer.records[:3] == [("name", "batch"), ("step", 0), ("loss", 0.5)]
+    assert replay(counter.path, Collect()) == 0
+
+
+def test_counters_shm_file_cleanup(tmp_path):
+    from cantilever.core.perfcounter_shm import PerfCounter
+
+    path = tmp_path / "count"
+    with PerfCounter(CountRecords, (path,), qsize, directory=tmp_path) as counter:
+        push_batched(counter, 20, 5)
+
+    assert int(path.read_text()) == 120
+    assert not os.path.exists(counter.path)
+
+
+def test_counters_shm_view(tmp_path, capsys):
+    from cantilever.core import top
+    from cantilever.core.perfcounter_shm import CounterView, PerfCounter, discover
+
+    path = tmp_path / "count"
+    with PerfCounter(SlowCountRecords, (path,), qsize) as counter:
+        for i in range(10):
+            counter.push_object(name="batch", step=i)
+
+        assert counter.name in discover()
+
+        with CounterView(counter.name) as view:
+            stats = view.stats()
+            assert stats["pid"] == os.getpid()
+            assert stats["index_in"] == 30
+            assert stats["objects"] == 10
+            assert view.records(2)[-1][1:] == ("step", 9)
+
+        top.main(["--once"])
+        assert counter.name in capsys.readouterr().out
+
+    assert counter.name not in discover()
+
 
 def test_counters_queue():
     from cantilever.core.perfcounter_queue import PerfCounter, Source
@@ -72,6 +677,211 @@ def test_counters_queue():
             counter.push_object(name="batch", time=time.time_ns(), batch_size=1024)
             fake_work()
 
+    report_consumer_cpu(counter)
+
+
+def test_queue_push_overhead(tmp_path):
+    from cantilever.core.perfcounter_queue import ManagerPerfCounter, PerfCounter
+
+    steps = 2000
+    for cls in (ManagerPerfCounter, PerfCounter):
+        path = tmp_path / cls.__name__
+
+        with cls(CountRecords, (path,), 20000, backpressure="block") as counter:
+            s = time.perf_counter_ns()
+            for i in range(steps):
+                counter.push_object(name="batch", step=i)
+            elapsed = time.perf_counter_ns() - s
+
+        print(f"{cls.__name__:>18} push: {elapsed / steps:8.0f} ns")
+        assert int(path.read_text()) == steps
+
+
+def test_counters_queue_batch_age(tmp_path):
+    from cantilever.core.perfcounter_queue import PerfCounter
+
+    path = tmp_path / "count"
+    with PerfCounter(CountRecords, (path,), qsize, batch_age=0.01) as counter:
+        for i in range(3):
+            counter.push_object(step=i)
+
+        # sent by age while the producer is idle
+        time.sleep(0.2)
+        assert counter.pending == []
+
+    assert int(path.read_text()) == 3
+
+
+def test_counters_queue_worker_killed():
+    from cantilever.core.perfcounter_queue import PerfCounter, WorkerStopped
+
+    pushed = 0
+    with PerfCounter(CrashOnEnter, (), qsize) as counter:
+        # the push following the batch that found the worker dead raises
+        with pytest.raises(WorkerStopped):
+            for i in range(2000):
+                counter.push_object(name="batch", step=i, payload="x" * 64)
+                pushed += 1
+                time.sleep(0.0001)
+
+    # what was in flight when the worker died is drained on exit
+    assert counter.counters()["dropped"] == pushed
+
+
+class CrashOnCall(CountRecords):
+    def __call__(self, *args):
+        time.sleep(0.2)
+        os._exit(1)
+
+
+def test_counters_queue_worker_killed_during_wait(tmp_path):
+    import threading
+
+    from cantilever.core.perfcounter_queue import PerfCounter
+
+    with PerfCounter(
+        CrashOnCall, (tmp_path / "count",), qsize, batch_size=1
+    ) as counter:
+        counter.push_object(step=0)
+        time.sleep(0.05)
+
+        # still in the queue when the worker dies
+        for i in range(50):
+            counter.push_object(step=i)
+
+        waiting = threading.Thread(target=counter.wait)
+        waiting.start()
+        waiting.join(timeout=5)
+        done = not waiting.is_alive()
+
+    assert done
+    assert counter.counters()["dropped"] == 50
+
+
+def test_counters_async():
+    import asyncio
+
+    from cantilever.core.perfcounter_async import PerfCounter, Source
+
+    async def main():
+        async with PerfCounter(Source, (metrics,), qsize) as counter:
+            for _ in range(n):
+                counter.push_object(name="batch", time=time.time_ns(), batch_size=1024)
+                fake_work()
+                await asyncio.sleep(0)
+
+        return counter
+
+    report_consumer_cpu(asyncio.run(main()))
+
+
+class AsyncCountBatches(CountRecords):
+    async def on_batch(self, batch):
+        await asyncio.sleep(0.001)
+        self.count += len(batch)
+
+
+@pytest.mark.parametrize("policy", ["drop", "overwrite", "sample"])
+def test_counters_async_backpressure(tmp_path, policy):
+    from cantilever.core.perfcounter_async import PerfCounter
+
+    path = tmp_path / "count"
+    steps = 200
+
+    async def main():
+        async with PerfCounter(
+            AsyncCountBatches, (path,), 16, backpressure=policy
+        ) as counter:
+            for i in range(steps):
+                counter.push_object(step=i)
+                if i % 50 == 0:
+                    await counter.wait()
+
+        return counter.counters()
+
+    counters = asyncio.run(main())
+    print(policy, counters)
+
+    delivered = int(path.read_text())
+    assert delivered + counters["dropped"] + counters["overwritten"] == steps
+    assert counters["high_water"] == 16
+
+
+def test_counters_reactivex():
+    rx_ops = pytest.importorskip("reactivex.operators")
+    from cantilever.core.perfcounter import PerfCounter, RxSource
+
+    steps = []
+
+    def handler(source, observer, scheduler):
+        source.pipe(
+            rx_ops.filter(lambda obj: obj["name"] == "batch"),
+            rx_ops.map(lambda obj: obj["step"]),
+        ).subscribe(on_next=steps.append)
+
+    with PerfCounter(RxSource, (handler,), backend="thread") as counter:
+        for i in range(10):
+            counter.push_object(name="batch", step=i)
+
+    assert steps == list(range(10))
+
+
+def test_source_replay():
+    from cantilever.core.perfcounter import Source
+
+    streams = []
+    values = []
+    source = Source(lambda stream, observer, scheduler: streams.append(stream), 3)
+
+    with source:
+        for i in range(5):
+            source.push(i)
+
+        # subscribes late
+        streams[0].subscribe(on_next=values.append)
+
+        with pytest.warns(UserWarning):
+            source.push(5)
+        source.on_batch([6, 7])
+
+    assert values == [2, 3, 4, 5, 6, 7]
+    assert source.replay_dropped == 2
+
+
+def test_source_replay_reactivex():
+    pytest.importorskip("reactivex")
+    from cantilever.core.perfcounter import RxSource
+
+    observables = []
+    values = []
+    source = RxSource(lambda obs, observer, scheduler: observables.append(obs))
+
+    with source:
+        for i in range(3):
+            source.push(i)
+
+        observables[0].subscribe(on_next=values.append)
+
+        for i in range(3, 6):
+            source.push(i)
+
+    # replayed exactly once
+    assert values == list(range(6))
+    assert source.replay_dropped == 0
+
+
+def test_replay_buffer_age():
+    from cantilever.core.perfcounter import ReplayBuffer
+
+    pending = ReplayBuffer(10, age=0.05)
+    pending.append(0)
+    time.sleep(0.1)
+    pending.append(1)
+
+    with pytest.warns(UserWarning):
+        assert pending.flush() == [1]
+    assert pending.dropped == 1
+
 
 def test_counters_thread():
     from cantilever.core.perfcounter_thread import PerfCounter, Source
@@ -100,6 +910,9 @@ def test_counters_thread():
         #   elapsed = start.elapsed_time(end)
         #   perf.append(bs / elapsed)
 
+    report_consumer_cpu(counter)
+
+
 def counters_nothing():
     s = time.time_ns()
 
@@ -0,0 +1,60 @@
+import pytest
+
+from cantilever.core import stream as ops
+from cantilever.core.stream import Stream
+
+
+def run(operators, batches):
+    source = Stream()
+    values = []
+    source.pipe(*operators).subscribe(on_next=values.append)
+
+    for batch in batches:
+        source.on_batch(batch)
+    source.on_completed()
+    return values
+
+
+@pytest.mark.parametrize("batches", [[[1, 2, 3, 4, 5]], [[1], [2, 3], [], [4, 5]]])
+def test_stream_operators(batches):
+    assert run([ops.filter(lambda v: v % 2), ops.map(lambda v: v * 10)], batches) == [
+        10,
+        30,
+        50,
+    ]
+    assert run([ops.pairwise()], batches) == [(1, 2), (2, 3), (3, 4), (4, 5)]
+    assert run([ops.average()], batches) == [3]
+    assert run([ops.window_average(2)], batches) == [1, 1.5, 2.5, 3.5, 4.5]
+
+    rates = run([ops.rate(time=lambda v: v, unit=1)], batches)
+    assert rates == [1.0, 1.0, 1.0, 1.0]
+
+
+def test_stream_subscribers():
+    source = Stream()
+    batches = []
+    errors = []
+    completed = []
+
+    doubled = source.pipe(ops.map(lambda v: 2 / v))
+    doubled.subscribe(
+        on_batch=batches.append,
+        on_error=errors.append,
+        on_completed=lambda: completed.append(True),
+    )
+
+    source.on_batch([1, 2])
+    source.on_next(0)
+
+    # only the faulty value is lost
+    source.on_batch([4, 0, 8])
+    source.on_completed()
+
+    assert batches == [[2.0, 1.0], [0.5, 0.25]]
+    assert len(errors) == 2 and isinstance(errors[0], ZeroDivisionError)
+    assert completed == [True]
+
+
+def test_stream_pipe_reactivex():
+    with pytest.raises(TypeError, match="RxSource"):
+        Stream().pipe(ops.filter(bool), lambda source: source)
@@ -1,5 +1,9 @@
+import math
+import statistics
 import time
 
+import pytest
+
 from cantilever.core.timer import show_timings, timeit
 
 
@@ -11,3 +15,246 @@ def test_timer():
                 time.sleep(0.1)
 
     show_timings(force=True)
+
+
+def test_statstream_local_and_shared():
+    from cantilever.core.statstream import StatStream
+
+    local, shared = StatStream(2), StatStream(2, shared=True)
+    for v in [5, 1, 2, 3, 4.5, 2]:
+        local.update(v)
+        shared.update(v)
+
+    assert local.to_dict() == shared.to_dict()
+    assert local.state_dict() == shared.state_dict()
+    # the first 2 observations are dropped
+    assert (local.min, local.max, local.count) == (2, 4.5, 4)
+
+
+def test_statstream_merge():
+    import functools
+    import random
+
+    from cantilever.core.statstream import StatStream
+
+    values = [1e9 + random.random() for _ in range(1000)]
+
+    full = StatStream(0)
+    parts = [StatStream(0) for _ in range(3)]
+    for i, v in enumerate(values):
+        full.update(v)
+        parts[i % 3].update(v)
+
+    merged = functools.reduce(StatStream.merge, parts, StatStream(0, shared=True))
+
+    assert merged.count == full.count == 1000
+    assert (merged.min, merged.max) == (min(values), max(values))
+    assert merged.avg == pytest.approx(full.avg, rel=1e-12)
+    assert merged.sd == pytest.approx(full.sd, rel=1e-6)
+    assert full.sd == pytest.approx(statistics.pstdev(values), rel=1e-6)
+
+
+def test_statstream_percentiles(capsys):
+    import random
+    from functools import partial
+
+    from cantilever.core.chrono import MultiStageChrono
+    from cantilever.core.sketch import QuantileSketch
+    from cantilever.core.statstream import StatStream
+
+    values = [random.lognormvariate(-5, 1) for _ in range(10000)]
+    exact = sorted(values)
+
+    full = StatStream(0, sketch=True)
+    parts = [StatStream(0, sketch=True) for _ in range(2)]
+    for i, v in enumerate(values):
+        full.update(v)
+        parts[i % 2].update(v)
+
+    merged = parts[0].merge(parts[1])
+    for p in (50, 95, 99):
+        expected = exact[int(p / 100 * (len(exact) - 1))]
+        assert full.percentile(p) == pytest.approx(expected, rel=0.011)
+        assert merged.percentile(p) == full.percentile(p)
+
+    assert set(full.to_dict()) >= {"p50", "p95", "p99"}
+    assert len(full.to_array()) == 8
+
+    for q in (0, 0.5, 1):
+        assert math.isnan(QuantileSketch().quantile(q))
+
+    chrono = MultiStageChrono(0, sketch=True)
+    with chrono.time("step"):
+        pass
+    chrono.report_csv()
+    assert "p99" in capsys.readouterr().out
+
+    # the columns follow the streams, a stage without sketch leaves them empty
+    chrono = MultiStageChrono(0, make_stream=partial(StatStream, sketch=True))
+    with chrono.time("step"):
+        pass
+    resumed = MultiStageChrono(0)
+    resumed.restore(chrono.snapshot())
+    with resumed.time("eval"):
+        pass
+
+    for timer in (chrono, resumed):
+        timer.report_csv()
+        assert "p99" in capsys.readouterr().out
+
+
+def test_timer_percentiles(capsys):
+    from cantilever.core.timer import SketchStatStreamValue, TimerGroup
+
+    with TimerGroup("root", value_type=SketchStatStreamValue) as group:
+        with group.timeit("step"):
+            pass
+
+    group.show()
+    assert "p95" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_statstream_update_many(shared):
+    np = pytest.importorskip("numpy")
+    from cantilever.core.statstream import StatStream
+
+    values = np.random.lognormal(-5, 1, 100)
+    weights = np.random.randint(1, 3, 100)
+
+    one = StatStream(5, shared=shared, sketch=True)
+    for v, w in zip(values, weights):
+        one.update(v, int(w))
+
+    # the first chunk ends before the warm-up does
+    many = StatStream(5, shared=shared, sketch=True)
+    for start, end in ((0, 2), (2, 40), (40, 100)):
+        many.update_many(values[start:end], weights[start:end])
+
+    assert many.state_dict() == pytest.approx(one.state_dict())
+    assert list(many.sketch.counts) == list(one.sketch.counts)
+
+    # any buffer works
+    array = StatStream(5)
+    array.update_many(memoryview(values))
+    assert array.count == 95
+
+
+def test_statstream_window(capsys):
+    import random
+
+    from cantilever.core.chrono import show_eta
+    from cantilever.core.statstream import StatStream, WindowStatStream
+
+    values = [1e6 + random.random() for _ in range(1050)]
+    stream = WindowStatStream(100, drop_first_obs=5)
+
+    for i, v in enumerate(values):
+        stream.update(v)
+
+        window = values[max(5, i - 99) : i + 1]
+        if window and i % 37 == 0:
+            assert stream.count == len(window)
+            assert stream.avg == pytest.approx(statistics.fmean(window), rel=1e-12)
+            assert stream.min == min(window)
+
+    window = values[-100:]
+    assert stream.sd == pytest.approx(statistics.pstdev(window), rel=1e-6)
+    assert stream.max == max(window)
+
+    with pytest.raises(TypeError):
+        StatStream(0).merge(stream)
+
+    # the total time covers every observation, not only the window
+    show_eta(1050, 2000, stream)
+    assert f"Total {stream.avg * 1050 / 60:6.2f} min" in capsys.readouterr().out
+
+
+def test_statstream_ewm(capsys):
+    from functools import partial
+
+    from cantilever.core.chrono import MultiStageChrono
+    from cantilever.core.statstream import EWMStatStream
+    from cantilever.core.timer import EWMStatStreamValue, TimerGroup
+
+    stream = EWMStatStream(halflife=1, drop_first_obs=0)
+    for v in [1, 1, 1, 3]:
+        stream.update(v)
+
+    # the last observation weighs half
+    assert stream.avg == pytest.approx(2)
+    assert stream.var == pytest.approx(1)
+    assert (stream.min, stream.max, stream.count) == (1, 3, 4)
+
+    chrono = MultiStageChrono(0, make_stream=partial(EWMStatStream, 0.5))
+    with chrono.time("step"):
+        pass
+    assert isinstance(chrono.chronos["step"], EWMStatStream)
+    chrono.report_csv()
+
+    # usable without arguments
+    chrono = MultiStageChrono(0, make_stream=EWMStatStream)
+    with chrono.time("step"):
+        pass
+    assert chrono.chronos["step"].alpha == 0.1
+
+    with TimerGroup("root", value_type=EWMStatStreamValue) as group:
+        with group.timeit("step"):
+            pass
+    group.show()
+
+
+def test_statstream_snapshot():
+    import random
+
+    from cantilever.core.chrono import MultiStageChrono
+    from cantilever.core.statstream import EWMStatStream, StatStream, WindowStatStream
+    from cantilever.core.timer import SketchStatStreamValue, TimerGroup
+
+    streams = [
+        StatStream(3, sketch=True),
+        StatStream(3, shared=True),
+        WindowStatStream(8, 3),
+        EWMStatStream(0.2, drop_first_obs=3),
+    ]
+    for stream in streams:
+        for _ in range(20):
+            stream.update(random.random())
+
+        restored = StatStream.from_snapshot(stream.snapshot())
+        assert type(restored) is type(stream)
+        assert restored.to_dict() == stream.to_dict()
+
+        # the restored stream carries on where the saved one stopped
+        for _ in range(10):
+            v = random.random()
+            stream.update(v)
+            restored.update(v)
+        assert restored.to_dict() == stream.to_dict()
+
+    assert StatStream.from_dict(streams[0].state_dict()).to_dict() == {
+        k: v for k, v in streams[0].to_dict().items() if not k.startswith("p")
+    }
+
+    restored = WindowStatStream.from_dict(streams[2].state_dict(), size=8)
+    assert type(restored) is WindowStatStream
+    assert restored.current_count == streams[2].current_count
+
+    chrono = MultiStageChrono(2, sketch=True)
+    for _ in range(5):
+        with chrono.time("forward"):
+            pass
+    resumed = MultiStageChrono(2, sketch=True)
+    resumed.restore(chrono.snapshot())
+    assert resumed.to_dict() == chrono.to_dict()
+
+    with TimerGroup("root", value_type=SketchStatStreamValue) as group:
+        with group.timeit("epoch") as epoch:
+            with epoch.timeit("step"):
+                pass
+    resumed = TimerGroup("root", value_type=SketchStatStreamValue)
+    resumed.restore(group.snapshot())
+    step = resumed.subgroups["epoch"].subgroups["step"]
+    assert step.timing.value.to_dict() == (
+        group.subgroups["epoch"].subgroups["step"].timing.value.to_dict()
+    )